@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Accuracy of the single precision (float32) propagation path against the
+float64 path, on the raw stacks and on the localized (X, Y, Z) positions.
+"""
+#%% Import libraries
+import numpy as np
+import functions as f
+from time import time
+from scipy.spatial import cKDTree
+
+
+#%% Accuracy report
+def accuracy_report(VID, I_MEDIAN, N, LAMBDA, MPP, SZ, NUMSTEPS, THRESHOLD, PMD, frames, scheme='-RS-'):
+    ## Compare float64 and float32 paths frame by frame
+    #   Inputs:  VID - 3D array of video (ni x nj x nk) or VideoSource
+    #       I_MEDIAN - median image
+    #         frames - frame numbers to compare
+    #         scheme - '-RS-' or '-MOD-'
+    #   Output: REPORT - dictionary of statistics (positions in um)
+    FS = (MPP/10)*0.711
+    batch = f.positions_batch if scheme == '-RS-' else f.positions_batch_modified
+
+    STACK_ERR, STACK_REF = [], []
+    DX, DY, DZ = [], [], []
+    N64, N32, MATCHED = 0, 0, 0
+    T64, T32 = 0, 0
+
+    for k in frames:
+        I = VID[:, :, k]
+
+        # Raw pixels
+        if scheme == '-RS-':
+            S64 = f.rayleighSommerfeldPropagator(I, I_MEDIAN.copy(), N, LAMBDA, FS, SZ, NUMSTEPS, True, False)
+            S32 = f.rayleighSommerfeldPropagator(I, I_MEDIAN.copy(), N, LAMBDA, FS, SZ, NUMSTEPS, True, False,
+                                                 dtype='float32')
+        else:
+            S64 = f.modified_propagator(I, I_MEDIAN.copy(), N, LAMBDA, FS, SZ, NUMSTEPS, True, True)
+            S32 = f.modified_propagator(I, I_MEDIAN.copy(), N, LAMBDA, FS, SZ, NUMSTEPS, True, True,
+                                        dtype='float32')
+        STACK_ERR.append(np.abs(S64 - S32).max())
+        STACK_REF.append(np.abs(S64).max())
+        del S64, S32
+
+        # Positions
+        T0 = time()
+        R64 = batch((I, I_MEDIAN.copy(), N, LAMBDA, MPP, SZ, NUMSTEPS, THRESHOLD, PMD, {'dtype': 'float64'}))
+        T64 += time() - T0
+        T0 = time()
+        R32 = batch((I, I_MEDIAN.copy(), N, LAMBDA, MPP, SZ, NUMSTEPS, THRESHOLD, PMD, {'dtype': 'float32'}))
+        T32 += time() - T0
+
+        P64 = np.stack((R64[0][0], R64[1][0], R64[2][0]), axis=1).astype('float64')
+        P32 = np.stack((R32[0][0], R32[1][0], R32[2][0]), axis=1).astype('float64')
+        N64 += len(P64)
+        N32 += len(P32)
+        if len(P64) == 0 or len(P32) == 0:
+            continue
+
+        # Match each float64 detection to the closest float32 detection (2 pixels + 1 step)
+        dist, idx = cKDTree(P32).query(P64, distance_upper_bound=2/FS + SZ)
+        ok = np.isfinite(dist)
+        MATCHED += ok.sum()
+        D = P64[ok] - P32[idx[ok]]
+        DX.append(D[:, 0])
+        DY.append(D[:, 1])
+        DZ.append(D[:, 2])
+
+    DX, DY, DZ = [np.abs(np.concatenate(d)) if len(d) > 0 else np.zeros(0) for d in (DX, DY, DZ)]
+
+    REPORT = {'frames': len(frames),
+              'stack max abs error': float(np.max(STACK_ERR)),
+              'stack max abs error (relative)': float(np.max(np.array(STACK_ERR) / np.array(STACK_REF))),
+              'detections float64': N64,
+              'detections float32': N32,
+              'matched': int(MATCHED),
+              'identical positions': int(np.sum((DX == 0) & (DY == 0) & (DZ == 0))),
+              'time float64 (s/frame)': T64 / len(frames),
+              'time float32 (s/frame)': T32 / len(frames)}
+
+    for name, d in (('X', DX), ('Y', DY), ('Z', DZ)):
+        if len(d) > 0:
+            REPORT['|d'+name+'| mean (um)'] = float(d.mean())
+            REPORT['|d'+name+'| p99 (um)'] = float(np.percentile(d, 99))
+            REPORT['|d'+name+'| max (um)'] = float(d.max())
+
+    return REPORT
+
+
+#%% Run report on a video
+if __name__ == '__main__':
+    import easygui as gui
+
+    PATH = gui.fileopenbox(default='/media/erick/NuevoVol/LINUX_LAP/PhD/Thesis/')
+    VALUES = gui.multenterbox(msg='Parameters', title='float32 accuracy report',
+                              fields=['Scheme (-RS- or -MOD-)', 'Refraction index', 'Wavelength (um)',
+                                      'Magnification', 'Step size (um)', 'Number of steps',
+                                      'Threshold', 'Peak min distance', 'Number of frames'],
+                              values=['-RS-', 1.3226, 0.642, 10, 10, 150, 0.1, 20, 20])
+
+    VID = f.VideoSource(PATH)
+    I_MEDIAN = f.medianImage(VID, 20)
+    frames = np.round(np.linspace(0, VID.shape[2]-1, int(VALUES[8]))).astype(int)
+
+    REPORT = accuracy_report(VID, I_MEDIAN, float(VALUES[1]), float(VALUES[2]), int(VALUES[3]),
+                             float(VALUES[4]), int(VALUES[5]), float(VALUES[6]), int(VALUES[7]),
+                             frames, scheme=VALUES[0])
+
+    for key in REPORT:
+        print(key, ':', REPORT[key])
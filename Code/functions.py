@@ -1,3 +1,6 @@
+from functools import lru_cache
+
+
 #%% rgb2gray
 def rgb2gray(img):
     ## Convert rgb image to grayscale using Y' = 0.299R'+0.587G' + 0.114B'
@@ -40,22 +43,47 @@ def square_image(img):
 
 
 #%% bandpassFilter
-def bandpassFilter(img, xs, xl):
+def bandpassFilter(img, xs, xl, dtype='float64'):
     ## Bandpass filter
     # Input: img - Grayscale image array (2D)
     #        xl  - Large cutoff size (Pixels)
     #        xs  - Small cutoff size (Pixels)
+    #      dtype - 'float64' or 'float32' (complex64 FFT)
     # Output: img_filt - filtered image
+    #         BPP      - bandpass mask (ifftshifted)
     import numpy as np
+    from functions import bandpassMask
 
     # FFT the grayscale image
-    imgfft = np.fft.fft2(img)
+    img = np.asarray(img, dtype=dtype)
+    imgfft = np.fft.fft2(img).astype(np.result_type(dtype, np.complex64), copy=False)
     img_fft = np.fft.fftshift(imgfft)
-    img_amp = abs(img_fft)
     del imgfft
 
+    BPP = bandpassMask(img.shape, xs, xl, dtype)
+    BP = np.fft.fftshift(BPP)
+    
+    # Filter image
+    filtered = BP * img_fft
+    img_filt = np.fft.ifftshift(filtered)
+    img_filt = np.fft.ifft2(img_filt)
+    # img_filt = np.rot90(np.real(img_filt),2)
+
+    return img_filt, BPP
+
+
+#%% bandpassMask
+@lru_cache(maxsize=8)
+def bandpassMask(shape, xs, xl, dtype='float64'):
+    ## Bandpass mask of bandpassFilter, cached per (shape, xs, xl, dtype)
+    # Input: shape - (rows, columns) of the image
+    #        xl  - Large cutoff size (Pixels)
+    #        xs  - Small cutoff size (Pixels)
+    # Output: BPP - bandpass mask (ifftshifted, read-only)
+    import numpy as np
+
     # Pre filter image information
-    [ni, nj] = img_amp.shape
+    [ni, nj] = shape
     MIS = ni
 
     # Create bandpass filter when BigAxis ==
@@ -68,27 +96,23 @@ def bandpassFilter(img, xs, xl):
     #         SCO[ii, jj] = np.exp(-((ii - MIS / 2) ** 2 + (jj - MIS / 2) ** 2) * (2 * xs / MIS) ** 2)
     # BP = SCO - LCO
 
-    jj, ii = np.meshgrid(np.arange(nj), np.arange(ni))
+    jj, ii = np.meshgrid(np.arange(nj, dtype=dtype), np.arange(ni, dtype=dtype))
     
     LCO = np.exp(-((ii-MIS/2)**2 + (jj-MIS/2)**2) * (2*xl/MIS)**2)
     SCO = np.exp(-((ii-MIS/2)**2 + (jj-MIS/2)**2) * (2*xs/MIS)**2)
     BP =  SCO - LCO
     BPP = np.fft.ifftshift(BP)
+    BPP.flags.writeable = False
     
-    # Filter image
-    filtered = BP * img_fft
-    img_filt = np.fft.ifftshift(filtered)
-    img_filt = np.fft.ifft2(img_filt)
-    # img_filt = np.rot90(np.real(img_filt),2)
-
-    return img_filt, BPP
+    return BPP
 
 
 #%% videoImport
-def videoImport(video, N):
+def videoImport(video, N, dtype='float32'):
     ## Import video as stack of images in a 3D array
     #   Input:  video   - path to video file
     #               N   - frame number to import
+    #           dtype   - dtype of the stack when N == 0 ('uint8' keeps the 8-bit values, 4x less memory)
     #   Output: imStack - 3D array of stacked images in 8-bit
     import cv2
     import numpy as np
@@ -107,7 +131,7 @@ def videoImport(video, N):
     if N == 0:
         # IMG = np.empty((NUM_FRAMES, HEIGHT, WIDTH, 3), dtype='float16')
         IMG = np.empty((HEIGHT, WIDTH, 3))
-        IM_STACK = np.empty((NUM_FRAMES, HEIGHT, WIDTH), dtype='float32')
+        IM_STACK = np.empty((NUM_FRAMES, HEIGHT, WIDTH), dtype=dtype)
 
         while (I < NUM_FRAMES and SUCCESS):
             SUCCESS, IMG = CAP.read()
@@ -137,6 +161,174 @@ def videoImport(video, N):
     return IM_STACK
 
 
+#%% VideoSource
+class VideoSource:
+    ## Video frames decoded once to a uint8 .npy cache and read lazily from disk
+    # The cache is frame-major (NK, NI, NJ) and memory mapped, so only the frames
+    # that are accessed are loaded. Indexing follows the videoImport layout
+    # (VID[:, :, k] is frame k), so medianImage and the scripts can use it in place
+    # of the array returned by videoImport.
+    #   Inputs:  video - path to video file
+    #            cache - path of the .npy cache (default: <video>_frames.npy)
+    #           invert - invert frames on read (frame.max() - frame)
+    #            dtype - dtype of the frames returned
+    def __init__(self, video, cache=None, invert=False, dtype='float32'):
+        import os
+        import numpy as np
+
+        if cache is None:
+            cache = os.path.splitext(video)[0] + '_frames.npy'
+
+        if not os.path.exists(cache) or os.path.getmtime(cache) < os.path.getmtime(video):
+            self.decode(video, cache)
+
+        self.video = video
+        self.cache = cache
+        self.invert = invert
+        self.dtype = dtype
+        self.FRAMES = np.load(cache, mmap_mode='r')
+        self.NK, self.NI, self.NJ = self.FRAMES.shape
+        self.shape = (self.NI, self.NJ, self.NK)
+
+    @staticmethod
+    def decode(video, cache):
+        ## Decode video (first channel) into the .npy cache
+        import os
+        import cv2
+        import numpy as np
+
+        CAP = cv2.VideoCapture(video)
+        NUM_FRAMES = int(CAP.get(cv2.CAP_PROP_FRAME_COUNT))
+        WIDTH = int(CAP.get(cv2.CAP_PROP_FRAME_WIDTH))
+        HEIGHT = int(CAP.get(cv2.CAP_PROP_FRAME_HEIGHT))
+
+        # Written to a temporary file first, an interrupted decode leaves no cache
+        TMP = cache + '.part'
+        FRAMES = np.lib.format.open_memmap(TMP, mode='w+', dtype='uint8', shape=(NUM_FRAMES, HEIGHT, WIDTH))
+
+        I = 0
+        SUCCESS = True
+        while (I < NUM_FRAMES and SUCCESS):
+            SUCCESS, IMG = CAP.read()
+            if SUCCESS:
+                FRAMES[I] = IMG[:, :, 0]
+                I += 1
+        CAP.release()
+
+        # Frame count reported by the container can be larger than the decoded one
+        if I < NUM_FRAMES:
+            np.save(TMP + '.npy', FRAMES[:I])
+            del FRAMES
+            os.replace(TMP + '.npy', TMP)
+        else:
+            FRAMES.flush()
+            del FRAMES
+        os.replace(TMP, cache)
+
+    def __len__(self):
+        return self.NK
+
+    def chunk(self, k0, k1):
+        ## Frames k0:k1, frame-major (k1-k0, NI, NJ)
+        import numpy as np
+
+        C = np.array(self.FRAMES[k0:k1], dtype=self.dtype)
+        if self.invert:
+            C = C.max(axis=(1, 2), keepdims=True) - C
+
+        return C
+
+    def frame(self, k):
+        ## Frame k (NI, NJ)
+        return self.chunk(k, k+1)[0]
+
+    def __getitem__(self, key):
+        ## VID[i, j, k] indexing of the videoImport stack (NI, NJ, NK)
+        import numpy as np
+
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),)*(3 - len(key))
+
+        if np.isscalar(key[2]):
+            return self.frame(key[2])[key[0], key[1]]
+
+        K = np.arange(self.NK)[key[2]]
+        C = np.array(self.FRAMES[K], dtype=self.dtype)
+        if self.invert:
+            C = C.max(axis=(1, 2), keepdims=True) - C
+
+        return np.moveaxis(C[:, key[0], key[1]], 0, -1)
+
+
+#%% share_array
+def share_array(A, shape=None, dtype=None):
+    ## Copy an array to shared memory once, so Pool workers can read it without pickling
+    #   Input:     A - numpy array (or VideoSource, which is already on disk and is not copied),
+    #                  None allocates an uninitialized array of the given shape and dtype
+    #                  to be filled in place through attach_array(SPEC)
+    #   Output:  SHM - SharedMemory block (None for a VideoSource), keep it alive and
+    #                  call SHM.close(); SHM.unlink() when the workers are done
+    #           SPEC - small description of the array to send to the workers, see attach_array
+    import numpy as np
+    from multiprocessing import shared_memory
+    from functions import VideoSource
+
+    if isinstance(A, VideoSource):
+        return None, ('video', A.video, A.cache, A.invert, A.dtype)
+
+    if A is None:
+        shape, dtype = tuple(int(n) for n in shape), np.dtype(dtype)
+        SHM = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape))*dtype.itemsize, 1))
+        return SHM, ('shm', SHM.name, shape, dtype.str)
+
+    A = np.asarray(A)
+    SHM = shared_memory.SharedMemory(create=True, size=max(A.nbytes, 1))
+    B = np.ndarray(A.shape, dtype=A.dtype, buffer=SHM.buf)
+    B[:] = A
+
+    return SHM, ('shm', SHM.name, A.shape, A.dtype.str)
+
+#%% attach_array
+_ATTACHED = {}
+
+
+def attach_array(SPEC):
+    ## Array described by SPEC (see share_array), attached once per process
+    #   Input:  SPEC - ('shm', name, shape, dtype) or ('video', video, cache, invert, dtype)
+    #   Output:    A - zero-copy view of the shared array, or VideoSource
+    import numpy as np
+    from multiprocessing import shared_memory
+    from functions import VideoSource
+
+    if SPEC in _ATTACHED:
+        return _ATTACHED[SPEC][1]
+
+    # Blocks of earlier videos are released (the oldest ones, when more than 4 are attached)
+    while len(_ATTACHED) >= 4:
+        SHM, A = _ATTACHED.pop(next(iter(_ATTACHED)))
+        del A
+        if SHM is not None:
+            try:
+                SHM.close()
+            except BufferError:     # Still referenced
+                pass
+
+    if SPEC[0] == 'video':
+        SHM = None
+        A = VideoSource(*SPEC[1:])
+    else:
+        try:
+            SHM = shared_memory.SharedMemory(name=SPEC[1], track=False)    # Python >= 3.13
+        except TypeError:
+            SHM = shared_memory.SharedMemory(name=SPEC[1])
+        A = np.ndarray(SPEC[2], dtype=SPEC[3], buffer=SHM.buf)
+
+    _ATTACHED[SPEC] = (SHM, A)
+
+    return A
+
+
 #%% exportAVI
 def exportAVI(filename, IM, NI, NJ, fps):
     ## Export 3D array to .AVI movie file
@@ -167,104 +359,451 @@ def exportAVI(filename, IM, NI, NJ, fps):
 
 
 #%% rayleighSommerfeldPropagator
-def rayleighSommerfeldPropagator(I, I_MEDIAN, N, LAMBDA, FS, SZ, NUMSTEPS, bandpass, med_filter):
+def rayleighSommerfeldPropagator(I, I_MEDIAN, N, LAMBDA, FS, SZ, NUMSTEPS, bandpass, med_filter,
+                                 backend='numpy', workers=None, chunk=16, dtype='float64'):
     ## Rayleigh-Sommerfeld Back Propagator
     #   Inputs:          I - hologram (grayscale)
     #             I_MEDIAN - median image
     #                    Z - numpy array defining defocusing distances
+    #              backend - FFT backend, see fft_backend
+    #              workers - FFT threads (scipy and pyfftw backends)
+    #                chunk - number of planes inverse transformed per batch
+    #                dtype - 'float64' or 'float32' (float32/complex64 the whole way)
     #   Output:        IMM - 3D array representing stack of images at different Z
     import numpy as np
-    from functions import bandpassFilter
-    from scipy.ndimage import median_filter
+    from functions import get_rs_propagator
 
-    # Divide by Median image
-    I_MEDIAN[I_MEDIAN == 0] = np.mean(I_MEDIAN) 
-    IN = I / I_MEDIAN
-    
-    if med_filter:
-        IN = median_filter(IN, size=1)
+    NI = np.shape(I)[0]  # Number of rows
+    NJ = np.shape(I)[1]  # Nymber of columns
 
-    if bandpass:
-        _, BP = bandpassFilter(IN, 2, 30)
-        E = np.fft.fftshift(BP) * np.fft.fftshift(np.fft.fft2(IN - 1))
-    else:
-        E = np.fft.fftshift(np.fft.fft2(IN - 1))
+    # Kernels are built once per parameter set and cached (see RSPropagator)
+    PROPAGATOR = get_rs_propagator(NI, NJ, N, LAMBDA, FS, SZ, NUMSTEPS)
+    IZ = PROPAGATOR.propagate(I, I_MEDIAN, bandpass, med_filter, backend, workers, chunk, dtype)
+
+    return IZ
 
 
-    # Patameters     #Set as input parameters
-    # N = 1.3226               # Index of refraction
-    LAMBDA = LAMBDA       # HeNe
-    FS = FS               # Sampling Frequency px/um
-    NI = np.shape(IN)[0]  # Number of rows
-    NJ = np.shape(IN)[1]  # Nymber of columns
-    # SZ = 10
-    Z = SZ*np.arange(0, NUMSTEPS)
-    # Z = (FS * (51 / 31)) * np.arange(0, NUMSTEPS)
-    #    Z = SZ*np.arange(0, NUMSTEPS)
-    K = 2 * np.pi * N / LAMBDA  # Wavenumber
+#%% RSPropagator
+class RSPropagator:
+    ## Rayleigh-Sommerfeld Back Propagator with precomputed kernels
+    # The NUMSTEPS kernels exp(-1j*K*Z[k]*Q) only depend on the frame size and
+    # the optical parameters, so they are built once and reused for every frame.
+    #   Inputs:     NI, NJ - number of rows and columns of the hologram
+    #                    N - index of refraction
+    #               LAMBDA - wavelength (um)
+    #                   FS - sampling frequency (px/um)
+    #                   SZ - step size (um)
+    #             NUMSTEPS - number of planes
+    #           precompute - keep the whole kernel stack in memory (False builds
+    #                        the kernels of each block when needed, for streaming)
+    def __init__(self, NI, NJ, N, LAMBDA, FS, SZ, NUMSTEPS, precompute=True):
+        import numpy as np
+
+        self.NI = NI
+        self.NJ = NJ
+        self.NUMSTEPS = NUMSTEPS
+
+        self.Z = SZ*np.arange(0, NUMSTEPS)
+        self.K = 2 * np.pi * N / LAMBDA  # Wavenumber
+
+        # Rayleigh-Sommerfeld Arrays
+        jj, ii = np.meshgrid(np.arange(NJ), np.arange(NI))
+        const = ((LAMBDA*FS)/(max([NI, NJ])*N))**2
+        P = const*((ii-NI/2)**2 + (jj-NJ/2)**2)
+
+        if (P > 1).any():
+            P = P / P.max()
+
+        P = np.conj(P)
+        Q = np.sqrt(1 - P) - 1
+
+        if all(self.Z >= 0):
+            Q = np.conj(Q)
+
+        # Kernels are kept ifftshifted so that no shift is needed per frame
+        self.Q = np.fft.ifftshift(Q)
+        self.R = None
+
+        # Kernel stack, one contiguous plane per Z
+        if precompute:
+            self.R = self.kernels(0, NUMSTEPS)
+            self.Q = None
+
+    def kernels(self, k0, k1):
+        ## Kernels of planes k0:k1, shape (k1-k0, NI, NJ)
+        import numpy as np
+
+        if self.R is not None:
+            return self.R[k0:k1]
+
+        R = np.empty([k1-k0, self.NI, self.NJ], dtype='complex64')
+        for k in range(k0, k1):
+            R[k-k0] = np.exp((-1j*self.K*self.Z[k]*self.Q), dtype='complex64')
+
+        return R
+
+    def planes(self, I, I_MEDIAN, bandpass=True, med_filter=False, backend='numpy', workers=None, chunk=16,
+               dtype='float64'):
+        ## Propagate a single frame, one block of planes at a time
+        #   Inputs: as propagate
+        #   Output: generator of (k0, k1, BLOCK), see propagate_planes
+        import numpy as np
+        from functions import bandpassMask, fft_backend, propagate_planes
+        from scipy.ndimage import median_filter
+
+        # Divide by Median image
+        I_MEDIAN[I_MEDIAN == 0] = np.mean(I_MEDIAN)
+        IN = (I / I_MEDIAN).astype(dtype, copy=False)
+
+        if med_filter:
+            IN = median_filter(IN, size=1)
+
+        # Spectrum kept in ifftshifted order: ifftshift(fftshift(BP)*fftshift(F)) = BPP*F
+        fft2, _ = fft_backend(backend, workers)
+        E = fft2(IN - 1).astype(np.result_type(dtype, np.complex64), copy=False)
+        if bandpass:
+            BPP = bandpassMask(IN.shape, 2, 30, dtype)
+            E = BPP * E
+
+        return propagate_planes(E, self.kernels, self.NUMSTEPS, chunk, backend, workers)
+
+    def propagate(self, I, I_MEDIAN, bandpass=True, med_filter=False, backend='numpy', workers=None, chunk=16,
+                  dtype='float64'):
+        ## Propagate a single frame
+        #   Inputs:          I - hologram (grayscale)
+        #             I_MEDIAN - median image
+        #              backend - FFT backend, see fft_backend
+        #              workers - FFT threads (scipy and pyfftw backends)
+        #                chunk - number of planes inverse transformed per batch
+        #                dtype - 'float64' or 'float32' (float32/complex64 the whole way)
+        #   Output:         IZ - 3D array representing stack of images at different Z
+        import numpy as np
+
+        IZ = np.empty([self.NI, self.NJ, self.NUMSTEPS], dtype='float32')
+
+        for k0, k1, BLOCK in self.planes(I, I_MEDIAN, bandpass, med_filter, backend, workers, chunk, dtype):
+            IZ[:, :, k0:k1] = np.moveaxis(BLOCK, 0, -1)
+
+        return IZ
+
+
+#%% get_rs_propagator
+@lru_cache(maxsize=2)
+def get_rs_propagator(NI, NJ, N, LAMBDA, FS, SZ, NUMSTEPS, precompute=True):
+    ## Cached RSPropagator, one per parameter set
+    # A 512x512x150 kernel stack takes ~300 MB, so only the last two parameter
+    # sets are kept (per process, i.e. per Pool worker).
+    return RSPropagator(NI, NJ, N, LAMBDA, FS, SZ, NUMSTEPS, precompute)
+
+
+#%% fft_backend
+_FFTW_MISSING = False
 
-    # Rayleigh-Sommerfeld Arrays
-    #P = np.empty_like(I_MEDIAN, dtype='complex64')
 
-    #for i in range(NI):
-    #    for j in range(NJ):
-    #        P[i, j] = ((LAMBDA * FS) / (max([NI, NJ]) * N)) ** 2 * ((i - NI / 2) ** 2 + (j - NJ / 2) ** 2)
+def fft_backend(name='numpy', workers=None):
+    ## FFT functions used by the propagators
+    #   Inputs:    name - 'numpy', 'scipy' or 'pyfftw' (scipy is used if pyFFTW is not installed)
+    #           workers - number of threads for scipy and pyfftw (None = library default)
+    #   Output:    fft2 - function (A, axes) returning the forward 2D FFT over axes
+    #             ifft2 - function (A, axes) returning the inverse 2D FFT over axes,
+    #                     A may be overwritten
+    import numpy as np
+    global _FFTW_MISSING
+
+    if name == 'numpy':
+        def fft2(A, axes=(-2, -1)):
+            return np.fft.fft2(A, axes=axes)
 
-    jj, ii = np.meshgrid(np.arange(NJ), np.arange(NI))
-    const = ((LAMBDA*FS)/(max([NI, NJ])*N))**2
-    P = const*((ii-NI/2)**2 + (jj-NJ/2)**2)
-    
-    if (P > 1).any():
-        P = P / P.max()
-    
-    P = np.conj(P)
-    Q = np.sqrt(1 - P) - 1
+        def ifft2(A, axes=(-2, -1)):
+            return np.fft.ifft2(A, axes=axes)
 
-    if all(Z >= 0):
-        Q = np.conj(Q)
+    elif name == 'scipy':
+        import scipy.fft
 
-    # R = np.empty([NI, NJ, Z.shape[0]], dtype=complex)
-    IZ = np.empty([NI, NJ, Z.shape[0]], dtype='float32')
+        def fft2(A, axes=(-2, -1)):
+            return scipy.fft.fft2(A, axes=axes, workers=workers)
 
-    for k in range(Z.shape[0]):
-        R = np.exp((-1j*K*Z[k]*Q), dtype='complex64')
-        IZ[:, :, k] = np.real(1 + np.fft.ifft2(np.fft.ifftshift(E*R)))
-    #        print(('RS', k))
-    return IZ
+        def ifft2(A, axes=(-2, -1)):
+            return scipy.fft.ifft2(A, axes=axes, workers=workers, overwrite_x=True)
+
+    elif name == 'pyfftw':
+        try:
+            import pyfftw
+            from pyfftw.interfaces import scipy_fft
+        except ImportError:
+            # Reported once per process, not on every frame
+            if not _FFTW_MISSING:
+                print('pyFFTW is not installed, using scipy.fft')
+                _FFTW_MISSING = True
+            return fft_backend('scipy', workers)
+
+        pyfftw.interfaces.cache.enable()
+
+        def fft2(A, axes=(-2, -1)):
+            return scipy_fft.fft2(A, axes=axes, workers=workers)
+
+        def ifft2(A, axes=(-2, -1)):
+            return scipy_fft.ifft2(A, axes=axes, workers=workers, overwrite_x=True)
+
+    else:
+        raise ValueError("FFT backend must be 'numpy', 'scipy' or 'pyfftw'")
+
+    return fft2, ifft2
+
+
+#%% propagate_planes
+def propagate_planes(E, KERNELS, NUMSTEPS, chunk=16, backend='numpy', workers=None):
+    ## Batched multi-plane inverse FFT
+    # E*R is formed for a block of planes in one broadcast, written into a
+    # preallocated buffer and inverse transformed with one multi-axis FFT.
+    #   Inputs:        E - 2D spectrum of the hologram (ifftshifted)
+    #            KERNELS - function (k0, k1) returning the ifftshifted kernels of
+    #                      planes k0:k1, shape (k1-k0, NI, NJ)
+    #           NUMSTEPS - number of planes
+    #              chunk - number of planes per block
+    #   Output: generator of (k0, k1, BLOCK) with BLOCK = real(1 + ifft2(E*R)),
+    #           float32 of shape (k1-k0, NI, NJ). BLOCK is overwritten by the next block
+    import numpy as np
+    from functions import fft_backend
+
+    _, ifft2 = fft_backend(backend, workers)
+    NI, NJ = np.shape(E)
+    chunk = max(1, min(int(chunk), NUMSTEPS))
+
+    BUFFER = None
+    BLOCK = np.empty([chunk, NI, NJ], dtype='float32')
+
+    for k0 in range(0, NUMSTEPS, chunk):
+        k1 = min(k0 + chunk, NUMSTEPS)
+        R = KERNELS(k0, k1)
+
+        if BUFFER is None:
+            BUFFER = np.empty([chunk, NI, NJ], dtype=np.result_type(E, R))
+
+        np.multiply(E, R, out=BUFFER[:k1-k0])
+        OUT = ifft2(BUFFER[:k1-k0], axes=(-2, -1))
+        np.add(OUT.real, 1, out=BLOCK[:k1-k0])
+
+        yield k0, k1, BLOCK[:k1-k0]
 
 
 #%% medianImage
-def medianImage(VID, numFrames):
+def medianImage(VID, numFrames, method='sample'):
     ## Median Image
-    #   Input:   VID - 3D numpy array of video file
-    #            numFrames - Number of frames to calculat median image
+    #   Input:   VID - 3D numpy array of video file (or VideoSource)
+    #            numFrames - Number of frames to calculat median image (None for all)
+    #            method - 'sample' (np.median of the frames stacked) or 'stream' (one frame
+    #                     at a time with StreamingMedian, 8-bit frames, same result)
     #   Output: MEAN - 2D pixel mean array
     import numpy as np
+    from functions import StreamingMedian, VideoSource
 
     def spaced_elements(array, numElems):
         out = array[np.round(np.linspace(0, len(array) - 1, numElems)).astype(int)]
         return out
 
     N = np.shape(VID)[2]
-    id = spaced_elements(np.arange(N), numFrames)
+    id = spaced_elements(np.arange(N), numFrames or N)
+
+    if method == 'stream':
+        SM = StreamingMedian(np.shape(VID)[:2], max_frames=len(id))
+        for k in id:
+            SM.add(VID.frame(k) if isinstance(VID, VideoSource) else VID[:, :, k])
+        return SM.median('float32')
 
     # print('MI')
-    MEAN = np.median(VID[:, :, id], axis=2)
+    STACK = VID[:, :, id]
+    MEAN = np.median(STACK, axis=2)
+
+    # 8-bit frames give the same median as float32 frames
+    if np.issubdtype(STACK.dtype, np.integer):
+        MEAN = MEAN.astype('float32')
 
     return MEAN
 
 
+#%% StreamingMedian
+class StreamingMedian:
+    ## Per-pixel median of a stream of 8-bit frames, from a histogram of each pixel
+    # Adding a frame costs O(pixels) and frames are not kept, so the median of a whole
+    # video is found in one pass over the frames.
+    #   Inputs:      shape - (NI, NJ) of the frames
+    #           max_frames - largest number of frames counted (sets the histogram dtype)
+    def __init__(self, shape, max_frames=65535):
+        import numpy as np
+
+        self.shape = tuple(shape)
+        self.COUNT = 0
+        self._PIXELS = np.arange(np.prod(self.shape))
+        dtype = 'uint8' if max_frames < 2**8 else 'uint16' if max_frames < 2**16 else 'uint32'
+        self.HIST = np.zeros((256, len(self._PIXELS)), dtype=dtype)
+
+        # Lower and upper middle values of each pixel and the number of values below them,
+        # kept up to date as frames are counted (Huang's running median)
+        self._MID = [[np.zeros(len(self._PIXELS), dtype='int16'), np.zeros(len(self._PIXELS), dtype='int64')]
+                     for _ in range(2)]
+
+    def _values(self, frame):
+        # Frame as flat uint8 (frames of other dtypes are rounded and clipped to 0-255)
+        import numpy as np
+
+        F = np.asarray(frame)
+        if F.shape != self.shape:
+            raise ValueError('Frame shape '+str(F.shape)+' does not match '+str(self.shape))
+        if F.dtype != np.uint8:
+            F = np.clip(np.rint(F), 0, 255).astype('uint8')
+
+        return F.ravel()
+
+    def add(self, frame):
+        ## Adds a frame (NI, NJ)
+        V = self._values(frame)
+        self.HIST[V, self._PIXELS] += 1
+        self.COUNT += 1
+        for VAL, BELOW in self._MID:
+            BELOW += V < VAL
+
+    def median(self, dtype='float32'):
+        ## Median image of the frames counted (NI, NJ)
+        # Float dtypes give the same result as np.median(STACK, axis=2), integer dtypes
+        # the mean of the two middle values rounded down. The middle values are moved
+        # one bin at a time from where they were at the previous call, only the pixels
+        # that changed are visited, so a slowly changing background costs O(pixels).
+        import numpy as np
+
+        if self.COUNT == 0:
+            raise ValueError('No frames added')
+
+        # Middle value: VAL with BELOW < t <= BELOW + HIST[VAL] (t-th smallest value)
+        for (VAL, BELOW), t in zip(self._MID, [(self.COUNT + 1) // 2, self.COUNT // 2 + 1]):
+            ACT = self._PIXELS
+            while len(ACT) > 0:
+                H = self.HIST[VAL[ACT], ACT]
+                UP = BELOW[ACT] + H < t
+                DOWN = BELOW[ACT] >= t
+
+                U = ACT[UP]
+                BELOW[U] += H[UP]
+                VAL[U] += 1
+
+                D = ACT[DOWN]
+                VAL[D] -= 1
+                BELOW[D] -= self.HIST[VAL[D], D]
+
+                ACT = ACT[UP | DOWN]
+
+        LO, HI = self._MID[0][0], self._MID[1][0]
+        if np.issubdtype(np.dtype(dtype), np.integer):
+            MED = (LO + HI) // 2
+        else:
+            MED = (LO + HI) / 2
+
+        return MED.reshape(self.shape).astype(dtype)
+
+
+#%% MovingMedian
+class MovingMedian(StreamingMedian):
+    ## Per-pixel median of a sliding window of 8-bit frames
+    # Frames entering and leaving the window update the histograms in O(pixels),
+    # instead of sorting the whole window again for every frame.
+    #   Inputs:  shape - (NI, NJ) of the frames
+    #           window - number of frames in the window
+    def __init__(self, shape, window):
+        StreamingMedian.__init__(self, shape, max_frames=window)
+        self.window = window
+
+    def remove(self, frame):
+        ## Removes a frame previously added
+        V = self._values(frame)
+        self.HIST[V, self._PIXELS] -= 1
+        self.COUNT -= 1
+        for VAL, BELOW in self._MID:
+            BELOW -= V < VAL
+
+
+#%% moving_median_images
+def moving_median_images(VID, window, frames=None, dtype='float32'):
+    ## Median image of the window of frames around each frame
+    # The window of frame k is the window frames centered on k, shifted to stay inside
+    # the video, so the first and last window/2 frames share the window of the ends.
+    #   Input:   VID - 3D array of video (ni x nj x nk) or VideoSource, 8-bit values
+    #         window - number of frames in the window
+    #         frames - increasing frame numbers (default all)
+    #          dtype - dtype of the median images (see StreamingMedian.median)
+    #   Output: generator of (k, MEDIAN) with MEDIAN of shape (ni, nj)
+    import numpy as np
+    from functions import MovingMedian, VideoSource
+
+    NI, NJ, NK = np.shape(VID)
+    window = min(int(window), NK)
+    frames = range(NK) if frames is None else frames
+
+    def frame(k):
+        return VID.frame(k) if isinstance(VID, VideoSource) else VID[:, :, k]
+
+    MM = MovingMedian((NI, NJ), window)
+    S0, S1 = 0, 0       # Frames S0:S1 in the window
+    for k in frames:
+        K0 = min(max(k - window // 2, 0), NK - window)
+        K1 = K0 + window
+        if K0 >= S1:
+            # No overlap with the previous window
+            MM = MovingMedian((NI, NJ), window)
+            S0 = S1 = K0
+        for i in range(S0, K0):
+            MM.remove(frame(i))
+        for i in range(max(S1, K0), K1):
+            MM.add(frame(i))
+        S0, S1 = K0, K1
+
+        yield k, MM.median(dtype)
+
+
 #%% zGradientStack
-def zGradientStack(IM):
+def zGradientStack(IM, dtype=None, separable=True, out=None):
     # Z-Gradient Stack
     #   Inputs:   I - hologram (grayscale)
     #            IM - median image
     #             Z - numpy array defining defocusing distances
+    #         dtype - dtype of the stack and of the output (None keeps the dtype of IM)
+    #     separable - 1D passes [1,2,1] x [1,2,1] x [-1,0,1] instead of the dense 3x3x3 convolution
+    #           out - array where the result is written (same shape as IM)
     #   Output: CONV - 3D array representing stack of images at different Z
     import numpy as np
     from scipy import ndimage
     from functions import rayleighSommerfeldPropagator, exportAVI
 
+    if dtype is not None:
+        IM = IM.astype(dtype, copy=False)
+
+    if out is None:
+        out = np.empty_like(IM)
+
+    if separable:
+        # In plane smoothing in double precision, then central difference in Z
+        # with replicated end planes (same as padding the stack with them).
+        # Done over blocks of planes (with the planes next to them), so only a
+        # block is held in double precision
+        NK = IM.shape[2]
+        if NK == 1:
+            out[:] = 0
+            return out
+
+        BLOCK = 16
+        for k0 in range(0, NK, BLOCK):
+            k1 = min(k0 + BLOCK, NK)
+            a, b = max(k0 - 1, 0), min(k1 + 1, NK)
+            S = ndimage.correlate1d(IM[:, :, a:b], [1, 2, 1], axis=0, mode='mirror', output=np.float64)
+            ndimage.correlate1d(S, [1, 2, 1], axis=1, mode='mirror', output=S)
+
+            K = np.arange(k0, k1)
+            LO = np.clip(K - 1, 0, NK - 1) - a
+            HI = np.clip(K + 1, 0, NK - 1) - a
+            np.subtract(S[:, :, LO], S[:, :, HI], out=out[:, :, k0:k1], casting='unsafe')
+        del S
+
+        return out
+
     #    I = mpimg.imread('131118-1.png')
     #    I_MEDIAN = mpimg.imread('AVG_131118-2.png')
     #    Z = 0.02*np.arange(1, 151)
@@ -281,12 +820,12 @@ def zGradientStack(IM):
     # IM = IM ** 2
     IMM = np.dstack((IM[:, :, 0][:, :, np.newaxis], IM, IM[:, :, -1][:, :, np.newaxis]))
     GS = ndimage.convolve(IMM, SZ, mode='mirror')
-    GS = np.delete(GS, [0, np.shape(GS)[2] - 1], axis=2)
-    del IMM
+    out[:] = GS[:, :, 1:-1]
+    del IMM, GS
 
     #    exportAVI('gradientStack.avi',CONV, CONV.shape[0], CONV.shape[1], 24)
     #    exportAVI('frameStack.avi', IM, IM.shape[0], IM.shape[1], 24)
-    return GS
+    return out
 
 
 #%% dataCursor1D
@@ -365,6 +904,7 @@ def guiImport():
 def positions3D(GS, peak_min_distance, num_particles, MPP):
     import numpy as np
     from skimage.feature import peak_local_max
+    from functions import z_refine, xy_refine
    
     ZP = np.max(GS, axis=-1)
     if num_particles == 'None':
@@ -377,59 +917,239 @@ def positions3D(GS, peak_min_distance, num_particles, MPP):
     # plt.scatter(PKS[:,1], PKS[:,0], marker='o', facecolors='none', s=80, edgecolors='r')
     # plt.show()
     
+    # Z profile of each peak: sum over the window [i-D, i+D) x [j-D, j+D), all windows
+    # gathered at once. Windows are truncated at the borders of the image (pixels outside
+    # count as 0, as in positions3D_streaming)
     D1 = int(MPP/10)
     D2 = int(MPP/10)
-    Z_SUM_XY = np.empty((GS.shape[2], len(PKS)))
-    for ii in range(len(PKS)):
-        idi = PKS[ii, 0]
-        idj = PKS[ii, 1]
-        A = GS[idi-D1:idi+D2:, idj-D1:idj+D2, :]                # How to treat borders?
-        Z_SUM_XY[:, ii] = np.sum(A, axis=(0, 1))
-    
-    Z_SUM_XY_MAXS_FOLDED = np.empty((len(PKS), 1), dtype=object)
-    for ii in range(len(PKS)):
-        Z_SUM_XY_MAXS_FOLDED[ii, 0] = peak_local_max(Z_SUM_XY[:, ii], num_peaks=1)
-        if Z_SUM_XY_MAXS_FOLDED[ii, 0].size == 0:
-            Z_SUM_XY_MAXS_FOLDED[ii, 0] = np.array([[0]])
-    
-    
-
-    Z_SUM_XY_MAXS = []
-    for ii in range(len(Z_SUM_XY_MAXS_FOLDED)):
-        if len(Z_SUM_XY_MAXS_FOLDED[ii, 0]) != 1:
-            for jj in range(len(Z_SUM_XY_MAXS_FOLDED[ii, 0])):
-                Z_SUM_XY_MAXS.append([Z_SUM_XY_MAXS_FOLDED[ii, 0][jj].item()])
-        else:
-            Z_SUM_XY_MAXS.append([Z_SUM_XY_MAXS_FOLDED[ii, 0].item()])
-    
-    Z_SUM_XY_MAXS = np.array(Z_SUM_XY_MAXS)
+    I = PKS[:, 0, None, None] + np.arange(-D1, D2)[:, None]
+    J = PKS[:, 1, None, None] + np.arange(-D1, D2)[None, :]
+    INSIDE = (I >= 0) & (I < GS.shape[0]) & (J >= 0) & (J < GS.shape[1])
+    A = GS[np.clip(I, 0, GS.shape[0]-1), np.clip(J, 0, GS.shape[1]-1)]     # (peaks, D1+D2, D1+D2, NUMSTEPS)
+    A[~INSIDE] = 0
+    Z_SUM_XY = np.sum(A, axis=(1, 2)).T.astype('float64')
+    
+    # Highest interior local maximum of each z-profile (peak_local_max(num_peaks=1) of every
+    # column at once, first plane wins ties), plane 0 when there is none
+    C = Z_SUM_XY[1:-1]
+    LOCAL = (C >= Z_SUM_XY[:-2]) & (C >= Z_SUM_XY[2:]) & (C > Z_SUM_XY.min(axis=0))
+    C = np.where(LOCAL, C, -np.inf)
+    Z_SUM_XY_MAXS = np.where(LOCAL.any(axis=0), np.argmax(C, axis=0) + 1, 0) if len(C) else np.zeros(len(PKS), dtype='int')
 
     # Use Z_SUM_XY and Z_SUM_XY_MAXS
     w = 2 #2
-    pol = lambda a, x: a[0]*x**2 + a[1]*x + a[2]
-    z_max = []
+    temp = np.pad(Z_SUM_XY, ((w, w), (0, 0)))
+    VALS = temp[Z_SUM_XY_MAXS + np.arange(2*w+1)[:, None], np.arange(len(PKS))].T
     
-    for j in range(len(Z_SUM_XY_MAXS)):
-        
-        i = Z_SUM_XY_MAXS[j][0]
-        idi = np.arange(i-w,i+w+1)
-        temp = np.pad(Z_SUM_XY, ((w, w), (0, 0)))
-        val = temp[idi+w, j]
-                
-        coefs = np.polyfit(idi, val, 2)
-        
-        interp_idi = np.linspace(idi[0], idi[-1], 10)
-        interp_val = pol(coefs, interp_idi)
-        
-        idi_max = np.where(interp_val == interp_val.max())[0][0]
-        z_max.append(interp_idi[idi_max])
+    z_max = z_refine(VALS, Z_SUM_XY_MAXS, w)
     
     # XYZ_POSITIONS = np.hstack((XYZ_POSITIONS, Z_SUM_XY_MAXS[:, 0]))    # YXZ_POSITIONS = np.insert(PKS, 2, Z_SUM_XY_MAXS[:, 0], axis=-1)         # Actually [Y, X, Z]
-    YXZ_POSITIONS = np.insert(np.float16(PKS), 2, z_max, axis=-1) 
+    YXZ_POSITIONS = np.column_stack((xy_refine(ZP, PKS), z_max)).astype('float32')
 
-    return YXZ_POSITIONS   # (x,y) in pixels, z in slice number
+    return YXZ_POSITIONS   # (x,y) in pixels (sub-pixel), z in slice number
 
 
+#%% z_refine
+def z_refine(VALS, IDX, w=2):
+    ## Sub-plane Z from a parabola fitted around the z-profile maximum
+    # Least squares parabola through the 2w+1 planes in closed form for all the peaks at
+    # once. The vertex is clipped to [IDX-w, IDX+w], profiles that are not concave take
+    # the end of the window where the fitted parabola is higher (IDX-w on ties).
+    #   Inputs: VALS - z-profile values at planes IDX-w ... IDX+w (zero outside the stack), one row per peak
+    #            IDX - plane of the z-profile maximum, one per peak
+    #   Output: z_max - array of refined Z (slice number)
+    import numpy as np
+    
+    VALS = np.asarray(VALS, dtype='float64').reshape(-1, 2*w+1)
+    IDX = np.asarray(IDX, dtype='float64')
+    
+    # y = a*x**2 + b*x + c with x = -w ... w
+    x = np.arange(-w, w+1)
+    x2 = x**2 - np.mean(x**2)
+    a = VALS @ x2 / np.sum(x2**2)
+    b = VALS @ x / np.sum(x**2)
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        VERTEX = np.clip(-b / (2*a), -w, w)
+    z_max = IDX + np.where(a < 0, VERTEX, np.where(b > 0, w, -w))
+    
+    return z_max
+
+#%% xy_refine
+def xy_refine(ZP, PKS):
+    ## Sub-pixel [Y, X] of the peaks of the Z max projection
+    # Vertex of the parabola through the peak pixel and its two neighbours, along each
+    # axis, for all the peaks at once. Offsets are clipped to [-0.5, 0.5], peaks on the
+    # border of the image or without curvature along an axis are not moved along it.
+    #   Inputs: ZP - Z max projection (2D)
+    #          PKS - integer [Y, X] of the peaks, one row per peak
+    #   Output: YX - sub-pixel [Y, X], one row per peak
+    import numpy as np
+    
+    PKS = np.asarray(PKS, dtype='int').reshape(-1, 2)
+    YX = PKS.astype('float64')
+    C = ZP[PKS[:, 0], PKS[:, 1]].astype('float64')
+    
+    for axis in range(2):
+        STEP = np.zeros(2, dtype='int')
+        STEP[axis] = 1
+        INSIDE = (PKS[:, axis] > 0) & (PKS[:, axis] < ZP.shape[axis] - 1)
+        LO = np.clip(PKS - STEP, 0, None)
+        HI = np.minimum(PKS + STEP, np.array(ZP.shape) - 1)
+        L = ZP[LO[:, 0], LO[:, 1]].astype('float64')
+        R = ZP[HI[:, 0], HI[:, 1]].astype('float64')
+        
+        DEN = L - 2*C + R
+        with np.errstate(divide='ignore', invalid='ignore'):
+            OFFSET = np.clip((L - R) / (2*DEN), -0.5, 0.5)
+        YX[:, axis] += np.where(INSIDE & (DEN < 0), OFFSET, 0)
+    
+    return YX
+
+#%% yxz_index
+def yxz_index(YXZ, shape):
+    ## Integer stack indices of [Y, X, Z] positions (pixels, slice number)
+    # Y and X are rounded to the nearest pixel, Z is truncated to its plane, all are
+    # clipped to the stack
+    #   Inputs: YXZ - positions from positions3D, one row per peak
+    #         shape - shape of the stack (NI, NJ, NUMSTEPS)
+    #   Output:   A - integer [I, J, K], one row per peak
+    import numpy as np
+    
+    A = np.empty(np.shape(YXZ), dtype='int')
+    A[:, :2] = np.rint(YXZ[:, :2])
+    A[:, 2] = np.trunc(YXZ[:, 2])
+    
+    return np.clip(A, 0, np.array(shape[:3]) - 1)
+
+#%% Positions3D streaming
+def positions3D_streaming(PLANES, NUMSTEPS, THRESHOLD, peak_min_distance, MPP, gradient=True):
+    ## Positions3D on a stack that is received plane by plane and never stored
+    # Same result as zGradientStack + thresholding + positions3D (num_particles='None'),
+    # but only a few planes per pixel are kept: the running Z max projection, the
+    # best z-profile peak found so far (value and plane) and the 5 planes around it
+    # that are needed for the Z refinement and for the intensities.
+    #   Inputs:   PLANES - iterable of (k0, k1, BLOCK), BLOCK with shape (k1-k0, NI, NJ),
+    #                      e.g. RSPropagator.planes or modified_propagator_planes
+    #          THRESHOLD - GS values below THRESHOLD are set to 0
+    #           gradient - True:  PLANES are propagated images, the Z gradient is applied on the fly
+    #                      False: PLANES are already a gradient stack (modified propagator)
+    #   Output:      YXZ - [Y, X, Z] positions (pixels, slice number) as in positions3D
+    #               I_FS - propagated image intensity at the positions
+    #               I_GS - gradient stack intensity at the positions
+    import numpy as np
+    from scipy import ndimage
+    from skimage.feature import peak_local_max
+    from functions import z_refine, xy_refine
+    
+    n = NUMSTEPS
+    D = int(MPP/10)
+    w = 2
+    
+    def smooth(P):
+        # In plane part of the Sobel-type kernel of zGradientStack
+        S = ndimage.correlate1d(P.astype('float64'), [1, 2, 1], axis=0, mode='mirror')
+        return ndimage.correlate1d(S, [1, 2, 1], axis=1, mode='mirror')
+    
+    def stack():
+        # (k, IM_k, GS_k), GS_k = S(IM_k-1) - S(IM_k+1) with replicated end planes
+        S = []
+        IM = []
+        for k0, k1, BLOCK in PLANES:
+            for k in range(k1-k0):
+                P = BLOCK[k].copy()
+                if not gradient:
+                    yield k0+k, P, P
+                    continue
+                S.append(smooth(P))
+                IM.append(P)
+                if len(S) == 2:
+                    yield 0, IM[0], (S[0] - S[1]).astype('float32')
+                elif len(S) == 3:
+                    yield k0+k-1, IM[1], (S[0] - S[2]).astype('float32')
+                    del S[0], IM[0]
+        if gradient and len(S) == 1:
+            yield 0, IM[0], np.zeros_like(IM[0])
+        elif gradient:
+            yield n-1, IM[-1], (S[-2] - S[-1]).astype('float32')
+    
+    HIST = []      # (B, IM, GS) of the last 4 planes
+    FIRST = []     # (B, IM, GS) of planes 0, 1, 2
+    for k, P_IM, P_GS in stack():
+        P_GS[P_GS < THRESHOLD] = 0
+        
+        # Z_SUM_XY of positions3D for every pixel, window [i-D, i+D) x [j-D, j+D)
+        PP = np.pad(P_GS, D)
+        B = np.zeros_like(P_GS)
+        for di in range(2*D):
+            for dj in range(2*D):
+                B += PP[di:di+P_GS.shape[0], dj:dj+P_GS.shape[1]]
+        
+        if k == 0:
+            ZP = P_GS.copy()
+            MINB = B.copy()
+            BEST = np.full_like(B, -np.inf)
+            ARG = np.full(B.shape, -1)
+            SLOTS = np.zeros((3, 2*w+1) + B.shape, dtype='float32')
+        else:
+            np.maximum(ZP, P_GS, out=ZP)
+            np.minimum(MINB, B, out=MINB)
+        
+        HIST.append((B, P_IM, P_GS))
+        if len(HIST) > 4:
+            del HIST[0]
+        if k < 3:
+            FIRST.append(HIST[-1])
+        
+        # Last plane of the window of the current best peaks
+        if k >= 3:
+            PEND = ARG == k-2
+            for s in range(3):
+                SLOTS[s, -1][PEND] = HIST[-1][s][PEND]
+        
+        # Interior local maximum of the z-profile at c = k-1 (as peak_local_max, first one wins ties)
+        if k >= 2:
+            c = k-1
+            BC = HIST[-2][0]
+            NEW = (BC >= HIST[-3][0]) & (BC >= B) & (BC > BEST)
+            BEST[NEW] = BC[NEW]
+            ARG[NEW] = c
+            for m in range(2*w):
+                z = c-w+m
+                for s in range(3):
+                    SLOTS[s, m][NEW] = HIST[z-k-1][s][NEW] if z >= 0 else 0
+            for s in range(3):
+                SLOTS[s, -1][NEW] = 0
+    
+    PKS = peak_local_max(ZP, min_distance=peak_min_distance)
+    ii, jj = PKS[:, 0], PKS[:, 1]
+    
+    # Peaks without a z-profile maximum fall back to plane 0, as in positions3D
+    VALID = BEST[ii, jj] > MINB[ii, jj]
+    IDX = np.where(VALID, ARG[ii, jj], 0)
+    VALS = SLOTS[0][:, ii, jj].T.astype('float64')
+    for j in np.flatnonzero(~VALID):
+        VALS[j] = [0, 0] + [F[0][ii[j], jj[j]] for F in FIRST] + [0]*(3-len(FIRST))
+    
+    z_max = z_refine(VALS, IDX, w)
+    YXZ = np.column_stack((xy_refine(ZP, PKS), z_max)).astype('float32')
+    # Plane of the intensities as in yxz_index, at the peak pixel
+    K = np.clip(np.trunc(YXZ[:, 2]).astype('int'), 0, n-1)
+    
+    I_FS = np.empty(len(PKS), dtype='float32')
+    I_GS = np.empty(len(PKS), dtype='float32')
+    for j in range(len(PKS)):
+        z = K[j]
+        if VALID[j]:
+            m = z - IDX[j] + w
+            H = [None, SLOTS[1, m], SLOTS[2, m]]
+        else:
+            H = FIRST[z]
+        I_FS[j] = H[1][ii[j], jj[j]]
+        I_GS[j] = H[2][ii[j], jj[j]]
+    
+    return YXZ, I_FS, I_GS
+
 #%% plot3D
 def plot3D(LOCS):
     # 3D Scatter Plot
@@ -527,30 +1247,57 @@ def imshow_slider(cube, axis, color_map):
     plt.show()
     
 #%% modified_propagator
-def modified_propagator(I, I_MEDIAN, N, LAMBDA, FS, SZ, NUMSTEPS, bandpass, med_filter):
+def modified_propagator(I, I_MEDIAN, N, LAMBDA, FS, SZ, NUMSTEPS, bandpass, med_filter,
+                        backend='numpy', workers=None, chunk=16, dtype='float64'):
     ## Modified Propagator
     #   Inputs:          I - hologram (grayscale)
     #             I_MEDIAN - median image
     #                    Z - numpy array defining defocusing distances
+    #              backend - FFT backend, see fft_backend
+    #              workers - FFT threads (scipy and pyfftw backends)
+    #                chunk - number of planes inverse transformed per batch
+    #                dtype - 'float64' or 'float32' (float32/complex64 the whole way)
     #   Output:        GS - 3D Gradient Stack
+    import numpy as np
+    from functions import modified_propagator_planes
+
+    GS = np.empty([np.shape(I)[0], np.shape(I)[1], NUMSTEPS], dtype='float32')
+
+    for k0, k1, BLOCK in modified_propagator_planes(I, I_MEDIAN, N, LAMBDA, FS, SZ, NUMSTEPS, bandpass,
+                                                    med_filter, backend, workers, chunk, dtype):
+        GS[:, :, k0:k1] = np.moveaxis(BLOCK, 0, -1)
+
+    # _, BINS = np.histogram(GS.flatten(), bins=100)
+    # GS[GS < BINS[60]] = 0   # 60
+    # GS[GS < 400] = 0
+    
+    return GS
+
+#%% modified_propagator_planes
+def modified_propagator_planes(I, I_MEDIAN, N, LAMBDA, FS, SZ, NUMSTEPS, bandpass, med_filter,
+                               backend='numpy', workers=None, chunk=16, dtype='float64'):
+    ## Modified Propagator, one block of planes at a time
+    #   Inputs: as modified_propagator
+    #   Output: generator of (k0, k1, BLOCK), see propagate_planes
     
     import numpy as np
-    from functions import bandpassFilter, histeq
+    from functions import bandpassMask, fft_backend, propagate_planes
     from scipy.ndimage import median_filter
 
     # Divide by Median image
     I_MEDIAN[I_MEDIAN == 0] = np.mean(I_MEDIAN)
-    IN = I / I_MEDIAN
+    IN = (I / I_MEDIAN).astype(dtype, copy=False)
 
     if med_filter:
         IN = median_filter(IN, size=1)
 
-    # Bandpass Filter
+    # Bandpass Filter (spectrum kept in ifftshifted order)
+    CDTYPE = np.result_type(dtype, np.complex64)
+    fft2, _ = fft_backend(backend, workers)
+    E = fft2(IN - 1).astype(CDTYPE, copy=False)
     if bandpass:
-        _, BP = bandpassFilter(IN, 2, 30)
-        E = np.fft.fftshift(BP) * np.fft.fftshift(np.fft.fft2(IN - 1))
-    else:
-        E = np.fft.fftshift(np.fft.fft2(IN - 1))
+        BPP = bandpassMask(IN.shape, 2, 30, dtype)
+        E = BPP * E
 
     # Patameter
     LAMBDA = LAMBDA       # HeNe
@@ -581,18 +1328,16 @@ def modified_propagator(I, I_MEDIAN, N, LAMBDA, FS, SZ, NUMSTEPS, bandpass, med_
     if all(Z > 0):
         Q = np.conj(Q)
 
-    GS = np.empty([NI, NJ, Z.shape[0]], dtype='float32')
+    # Kernels are built per block of planes, in ifftshifted order. The phase
+    # K*Z*Q reaches ~1e4 rad, so it is always evaluated in double precision
+    Q = np.fft.ifftshift(Q)
+    QQ = 2*np.pi*1j*np.fft.ifftshift(q)
 
-    for k in range(Z.shape[0]):
-        R = 2*np.pi*1j*q * np.exp(1j*K*Z[k]*Q)
-        # GS[:, :, k] = np.abs(1 + np.fft.ifft2(np.fft.ifftshift(E*R)))
-        GS[:, :, k] = np.real(1 + np.fft.ifft2(np.fft.ifftshift(E*R)))
+    def kernels(k0, k1):
+        return (QQ * np.exp(1j*K*Z[k0:k1, np.newaxis, np.newaxis]*Q)).astype(CDTYPE, copy=False)
+
+    return propagate_planes(E, kernels, Z.shape[0], chunk, backend, workers)
 
-    # _, BINS = np.histogram(GS.flatten(), bins=100)
-    # GS[GS < BINS[60]] = 0   # 60
-    # GS[GS < 400] = 0
-    
-    return GS
 #%% Smooth trajectories piecewise cubic spline
 def smooth_curve(L, spline_degree, lim, sc):
     import numpy as np
@@ -755,23 +1500,36 @@ def get_speed(s):
 
 #%% Contiguous repeats
 
-def contiguous_repeats(array):
+def run_lengths(array):
+    ## Run length encoding of a 1D array
+    #   Input: array - 1D array
+    #   Output: STARTS - index of the first element of each run of equal values
+    #           LENGTHS - number of elements of each run
     import numpy as np
     
-    x_b = 0*np.ones_like(array)
+    array = np.asarray(array)
+    if len(array) == 0:
+        return np.zeros(0, dtype='int'), np.zeros(0, dtype='int')
+    
+    # NaN != NaN, so every NaN is a run of its own as before
+    STARTS = np.concatenate(([0], np.flatnonzero(array[1:] != array[:-1]) + 1))
+    LENGTHS = np.diff(np.append(STARTS, len(array)))
+    
+    return STARTS, LENGTHS
 
-    i = 0
-    while i < len(array):
-        repeats = 1
-        val = array[i]
-        for j in range(1, len(array)-i):
-            if array[i+j] == val:
-                repeats = repeats + 1
-            else:
-                break
-        x_b[i:i+j+1] = repeats
-        i = i+repeats
-        
+def contiguous_repeats(array, return_runs=False):
+    ## Length of the run of equal values that each element belongs to
+    #   Input: array - 1D array
+    #          return_runs - also return the run starts and lengths (see run_lengths)
+    #   Output: x_b - run length for each element, same dtype as array
+    import numpy as np
+    
+    STARTS, LENGTHS = run_lengths(array)
+    x_b = np.repeat(LENGTHS, LENGTHS).astype(np.asarray(array).dtype)
+    
+    if return_runs:
+        return x_b, STARTS, LENGTHS
+    
     return x_b
 
 #%% Clean LINKED
@@ -936,17 +1694,29 @@ def positions_batch(TUPLE):
     NUMSTEPS = TUPLE[6]
     THRESHOLD = TUPLE[7]
     PMD = TUPLE[8]
+    OPTIONS = TUPLE[9] if len(TUPLE) > 9 else {}    # dtype, backend, workers, stream, chunk, frame
+    DTYPE = OPTIONS.get('dtype', 'float64')
     
     LOCS = np.empty((1, 3), dtype=object)
     X, Y, Z, I_FS, I_GS = [], [] ,[], [], []
-    IM = f.rayleighSommerfeldPropagator(I, I_MEDIAN, N, LAMBDA, FS, SZ, NUMSTEPS, True, False).astype('float32')
-    GS = f.zGradientStack(IM).astype('float32')  
-    # GS = f.modified_propagator(I, I_MEDIAN, N, LAMBDA, FS, SZ, NUMSTEPS)  # Modified propagator
-    GS[GS < THRESHOLD] = 0
-    LOCS[0, 0] = f.positions3D(GS, peak_min_distance=PMD, num_particles='None', MPP=MPP)
-    A = LOCS[0, 0].astype('int')
-    LOCS[0, 1] = IM[A[:, 0], A[:, 1], A[:, 2]]
-    LOCS[0, 2] = GS[A[:, 0], A[:, 1], A[:, 2]]
+    if OPTIONS.get('stream', False):
+        # Low memory: planes are propagated a few at a time and never stacked
+        PROP = f.get_rs_propagator(I.shape[0], I.shape[1], N, LAMBDA, FS, SZ, NUMSTEPS, False)
+        PLANES = PROP.planes(I, I_MEDIAN, True, False, OPTIONS.get('backend', 'numpy'),
+                             OPTIONS.get('workers'), OPTIONS.get('chunk', 4), DTYPE)
+        LOCS[0, 0], LOCS[0, 1], LOCS[0, 2] = f.positions3D_streaming(PLANES, NUMSTEPS, THRESHOLD, PMD, MPP)
+    else:
+        IM = f.rayleighSommerfeldPropagator(I, I_MEDIAN, N, LAMBDA, FS, SZ, NUMSTEPS, True, False,
+                                            backend=OPTIONS.get('backend', 'numpy'),
+                                            workers=OPTIONS.get('workers'),
+                                            dtype=DTYPE).astype('float32')
+        GS = f.zGradientStack(IM, dtype='float32')
+        # GS = f.modified_propagator(I, I_MEDIAN, N, LAMBDA, FS, SZ, NUMSTEPS)  # Modified propagator
+        GS[GS < THRESHOLD] = 0
+        LOCS[0, 0] = f.positions3D(GS, peak_min_distance=PMD, num_particles='None', MPP=MPP)
+        A = f.yxz_index(LOCS[0, 0], GS.shape)
+        LOCS[0, 1] = IM[A[:, 0], A[:, 1], A[:, 2]]
+        LOCS[0, 2] = GS[A[:, 0], A[:, 1], A[:, 2]]
         
     X.append(LOCS[0, 0][:, 0]*(1/FS))
     Y.append(LOCS[0, 0][:, 1]*(1/FS))
@@ -954,7 +1724,7 @@ def positions_batch(TUPLE):
     I_FS.append(LOCS[0, 1])
     I_GS.append(LOCS[0, 2])
         
-    return [X, Y, Z, I_FS, I_GS]
+    return [X, Y, Z, I_FS, I_GS, OPTIONS.get('frame')]    # frame number passed back for unordered Pools
 
 #%% Positions batch modified
 def positions_batch_modified(TUPLE):
@@ -970,6 +1740,7 @@ def positions_batch_modified(TUPLE):
     NUMSTEPS = TUPLE[6]
     THRESHOLD = TUPLE[7]
     PMD = TUPLE[8]
+    OPTIONS = TUPLE[9] if len(TUPLE) > 9 else {}    # dtype, backend, workers, stream, chunk, frame
     
         # 0   1    2  3    4    5    6         7
     # zip(IT, MED, n, lam, mpp, sz, numsteps, pmd)
@@ -978,12 +1749,23 @@ def positions_batch_modified(TUPLE):
     X, Y, Z, I_FS, I_GS = [], [] ,[], [], []
     # IM = f.rayleighSommerfeldPropagator(I, I_MEDIAN, N, LAMBDA, FS, SZ, NUMSTEPS, True, False).astype('float32')
     # GS = f.zGradientStack(IM).astype('float32')  
-    GS = f.modified_propagator(I, I_MEDIAN, N, LAMBDA, FS, SZ, NUMSTEPS, True, True)  # Modified propagator
-    GS[GS < THRESHOLD] = 0
-    LOCS[0, 0] = f.positions3D(GS, peak_min_distance=PMD, num_particles='None', MPP=MPP)
-    A = LOCS[0, 0].astype('int')
-    LOCS[0, 1] = GS[A[:, 0], A[:, 1], A[:, 2]]
-    LOCS[0, 2] = GS[A[:, 0], A[:, 1], A[:, 2]]
+    if OPTIONS.get('stream', False):
+        # Low memory: planes are propagated a few at a time and never stacked
+        PLANES = f.modified_propagator_planes(I, I_MEDIAN, N, LAMBDA, FS, SZ, NUMSTEPS, True, True,
+                                              OPTIONS.get('backend', 'numpy'), OPTIONS.get('workers'),
+                                              OPTIONS.get('chunk', 4), OPTIONS.get('dtype', 'float64'))
+        LOCS[0, 0], LOCS[0, 1], LOCS[0, 2] = f.positions3D_streaming(PLANES, NUMSTEPS, THRESHOLD, PMD, MPP,
+                                                                     gradient=False)
+    else:
+        GS = f.modified_propagator(I, I_MEDIAN, N, LAMBDA, FS, SZ, NUMSTEPS, True, True,
+                                   backend=OPTIONS.get('backend', 'numpy'),
+                                   workers=OPTIONS.get('workers'),
+                                   dtype=OPTIONS.get('dtype', 'float64'))  # Modified propagator
+        GS[GS < THRESHOLD] = 0
+        LOCS[0, 0] = f.positions3D(GS, peak_min_distance=PMD, num_particles='None', MPP=MPP)
+        A = f.yxz_index(LOCS[0, 0], GS.shape)
+        LOCS[0, 1] = GS[A[:, 0], A[:, 1], A[:, 2]]
+        LOCS[0, 2] = GS[A[:, 0], A[:, 1], A[:, 2]]
         
     X.append(LOCS[0, 0][:, 0]*(1/FS))
     Y.append(LOCS[0, 0][:, 1]*(1/FS))
@@ -991,7 +1773,487 @@ def positions_batch_modified(TUPLE):
     I_FS.append(LOCS[0, 1])
     I_GS.append(LOCS[0, 2])
         
-    return [X, Y, Z, I_FS, I_GS]
+    return [X, Y, Z, I_FS, I_GS, OPTIONS.get('frame')]    # frame number passed back for unordered Pools
+#%% Positions batch shared
+def positions_batch_shared(TUPLE):
+    ## positions_batch / positions_batch_modified on a frame of a shared video
+    # Only the frame number, the array descriptions and the parameters are sent to
+    # the worker, the frame and the median image are read from shared memory (or
+    # from the VideoSource cache). Zeros of the median image must be replaced by
+    # the caller before sharing it, as the propagators do.
+    #   Input: TUPLE - (frame, VIDEO, MEDIAN, scheme, N, LAMBDA, MPP, SZ, NUMSTEPS, THRESHOLD, PMD, OPTIONS)
+    #                  VIDEO and MEDIAN from share_array, scheme '-RS-' or '-MOD-', MEDIAN can
+    #                  also be a stack of backgrounds, OPTIONS['background_slot'] is the one of
+    #                  the frame (see detect_positions_jobs)
+    #   Output: as positions_batch, [X, Y, Z, I_FS, I_GS, frame]
+    import functions as f
+
+    VID = f.attach_array(TUPLE[1])
+    I_MEDIAN = f.attach_array(TUPLE[2])
+    I = VID[:, :, TUPLE[0]]
+    OPTIONS = dict(TUPLE[11] if len(TUPLE) > 11 else {}, frame=TUPLE[0])
+
+    if I_MEDIAN.ndim == 3:
+        # Moving median, background of the frame in the ring of detect_positions_jobs
+        I_MEDIAN = I_MEDIAN[OPTIONS.pop('background_slot')].astype('float32')
+
+    batch = f.positions_batch if TUPLE[3] == '-RS-' else f.positions_batch_modified
+
+    return batch((I, I_MEDIAN) + tuple(TUPLE[4:11]) + (OPTIONS,))
+
+#%% positions_table
+def positions_table(results, frame_rate=None):
+    ## DataFrame of positions from the positions_batch outputs, concatenated once
+    #   Input:  results - positions_batch outputs [X, Y, Z, I_FS, I_GS(, frame)], the frame number
+    #                     is taken from the output when present, else from the position in results
+    #        frame_rate - adds TIME = FRAME / frame_rate
+    #   Output: POSITIONS - DataFrame with columns X, Y, Z, I_FS, I_GS, FRAME(, TIME) as float
+    import numpy as np
+    import pandas as pd
+
+    COLUMNS = ['X', 'Y', 'Z', 'I_FS', 'I_GS']
+    COUNTS = [len(r[0][0]) for r in results]
+    FRAMES = [r[5] if len(r) > 5 and r[5] is not None else i for i, r in enumerate(results)]
+
+    DATA = {}
+    for j, c in enumerate(COLUMNS):
+        DATA[c] = np.concatenate([np.asarray(r[j][0], dtype='float64') for r in results] + [np.zeros(0)])
+    DATA['FRAME'] = np.repeat(np.asarray(FRAMES, dtype='float64'), COUNTS)
+
+    if frame_rate is not None:
+        DATA['TIME'] = DATA['FRAME'] / frame_rate
+
+    return pd.DataFrame(DATA)
+
+#%% detect_positions
+def detect_positions(PATH, scheme, N, LAMBDA, MPP, SZ, NUMSTEPS, THRESHOLD, PMD, FRAME_RATE, invert=False,
+                     frames=None, options=None, processes=None, progress=True, normalization='median', window=40):
+    ## 3D positions of the particles in every frame of a video (multiprocessing)
+    #   Input:  PATH - path to video file
+    #         scheme - '-RS-' (Rayleigh-Sommerfeld + gradient stack) or '-MOD-' (modified propagator)
+    #     FRAME_RATE - frames per second, for the TIME column
+    #         invert - invert video
+    #         frames - frame numbers to process: None (all), number of frames from the start, or a sequence
+    #        options - positions_batch options (dtype, backend, workers, stream, chunk)
+    #      processes - Pool size (default cpu_count())
+    #  normalization - 'median', 'stream' or 'moving' background (see detect_positions_jobs)
+    #         window - frames of the moving median
+    #   Output: POSITIONS - DataFrame with columns X, Y, Z, I_FS, I_GS, FRAME, TIME
+    from functions import detect_positions_jobs
+
+    JOB = dict(PATH=PATH, scheme=scheme, N=N, LAMBDA=LAMBDA, MPP=MPP, SZ=SZ, NUMSTEPS=NUMSTEPS,
+               THRESHOLD=THRESHOLD, PMD=PMD, FRAME_RATE=FRAME_RATE, invert=invert, frames=frames, options=options,
+               normalization=normalization, window=window)
+
+    for _, POSITIONS, _ in detect_positions_jobs([JOB], processes, progress=progress):
+        return POSITIONS
+
+#%% detect_positions_jobs
+def detect_positions_jobs(JOBS, processes=None, max_pending=None, progress=True):
+    ## detect_positions for several videos with a single Pool
+    # A background thread decodes the next video and computes its median image while
+    # the frames of the current ones are processed, and frames of all the prepared
+    # videos are sent to the workers in turn, so the tail of a file does not leave
+    # cores idle. At most max_pending frames are queued to the workers at any time.
+    # Moving median backgrounds are computed by the same thread as a pipeline stage,
+    # each frame is sent to the workers as soon as its background is ready. They are
+    # kept in a ring of max_pending + processes shared images, a slot is reused once
+    # the frame that used it has come back from the workers.
+    #   Input:  JOBS - list of dictionaries with the arguments of detect_positions
+    #                  (PATH, scheme, N, LAMBDA, MPP, SZ, NUMSTEPS, THRESHOLD, PMD, FRAME_RATE
+    #                  and optionally invert, frames, first_frame, options, normalization, window,
+    #                  checkpoint, checkpoint_frames, resume, cache_dir)
+    #                  frames is None (all), a number of frames from first_frame (default 0) or a
+    #                  sequence of frame numbers, it is clipped to the video once it is decoded
+    #                  normalization is the background the frames are divided by: 'median' (median
+    #                  image of 20 frames, default), 'stream' (median image of all the frames) or
+    #                  'moving' (median of the window frames around each frame, default 40)
+    #                  checkpoint is a folder where the results are saved every checkpoint_frames
+    #                  frames (default 100) as they complete, with resume=True the frames found
+    #                  there (same parameters) are not processed again
+    #                  cache_dir is the folder of the decoded frames (VideoSource cache, default next
+    #                  to the video), for videos in read-only folders
+    #      processes - Pool size (default cpu_count())
+    #    max_pending - frames queued to the workers (default 2*processes)
+    #   Output: generator of (job number, POSITIONS, seconds) in the order the jobs finish,
+    #           POSITIONS.attrs['frames'] is the number of frames of the job
+    import os
+    import queue
+    import threading
+    import collections
+    import numpy as np
+    import functions as f
+    from time import time
+    from multiprocessing import Pool, cpu_count, resource_tracker
+
+    processes = processes or cpu_count()
+    max_pending = max_pending or 2*processes
+    PENDING = threading.Semaphore(max_pending)
+    READY = queue.Queue(maxsize=1)      # Only the next video is prepared in advance
+    BACKGROUND = threading.Condition()  # Notified as moving median backgrounds are computed
+    FINISHED = collections.deque()      # Jobs without frames to process, output as they are prepared
+
+    STATE = {}
+
+    def prepare():
+        # Decode (VideoSource cache), median image and shared memory of each job in turn
+        for j, JOB in enumerate(JOBS):
+            if 'stop' in STATE:
+                return
+            try:
+                CACHE = None
+                if JOB.get('cache_dir') is not None:
+                    os.makedirs(JOB['cache_dir'], exist_ok=True)
+                    CACHE = os.path.join(JOB['cache_dir'],
+                                         os.path.splitext(os.path.basename(JOB['PATH']))[0] + '_frames.npy')
+                VID = f.VideoSource(JOB['PATH'], cache=CACHE, invert=JOB.get('invert', False), dtype='uint8')
+                NORM = JOB.get('normalization', 'median')
+                if NORM not in ['median', 'stream', 'moving']:
+                    raise ValueError('Unknown normalization '+str(NORM))
+
+                frames = JOB.get('frames')
+                first = int(JOB.get('first_frame', 0))
+                if frames is None:
+                    frames = range(first, VID.NK)
+                elif np.isscalar(frames):
+                    frames = range(first, min(first + int(frames), VID.NK))
+                # Frames outside the video are skipped
+                frames = [int(k) for k in frames if 0 <= k < VID.NK]
+                INDEX = {k: i for i, k in enumerate(frames)}
+                results = np.empty(len(frames), dtype=object)
+
+                PARAMS = (JOB['scheme'], JOB['N'], JOB['LAMBDA'], JOB['MPP'], JOB['SZ'], JOB['NUMSTEPS'],
+                          JOB['THRESHOLD'], JOB['PMD'], JOB.get('options') or {})
+                CHECK = None
+                if JOB.get('checkpoint') is not None:
+                    CHECK = dict(folder=JOB['checkpoint'], frames=JOB.get('checkpoint_frames') or 100,
+                                 params=dict(video=os.path.abspath(JOB['PATH']), invert=JOB.get('invert', False),
+                                             scheme=PARAMS[:8], options=PARAMS[8], normalization=NORM,
+                                             window=JOB.get('window', 40) if NORM == 'moving' else None))
+                    os.makedirs(CHECK['folder'], exist_ok=True)
+                    if JOB.get('resume', False):
+                        for k, R in f.load_checkpoints(CHECK['folder'], CHECK['params']).items():
+                            if k in INDEX:
+                                results[INDEX[k]] = R
+                    # Frames of the job in each chunk, a chunk is saved once all its frames are done
+                    CHECK['pending'] = {}
+                    for k in frames:
+                        c = k // CHECK['frames']
+                        CHECK['pending'][c] = CHECK['pending'].get(c, 0) + (results[INDEX[k]] is None)
+
+                todo = [k for k in frames if results[INDEX[k]] is None]
+                MOVING = NORM == 'moving' and len(todo) > 0
+                if len(todo) == 0:
+                    # Nothing to process (no frames or all found in the checkpoints), the results
+                    # go straight to the output without median image nor shared memory
+                    SHM, MED, VIDEO = None, None, None
+                elif MOVING:
+                    # Ring of float32 backgrounds (exact medians, the mean of the two middle values
+                    # of an even window is not rounded), enough for the frames queued and being processed.
+                    # Frame todo[i] uses slot i % SLOTS, filled in below once the frame that used
+                    # it before has come back from the workers
+                    todo = sorted(todo)
+                    SLOTS = min(len(todo), max_pending + processes)
+                    SHM, MED = f.share_array(None, (SLOTS, VID.NI, VID.NJ), 'float32')
+                else:
+                    # Median image of 20 frames, or of all the frames in one pass
+                    I_MEDIAN = f.medianImage(VID, None, 'stream') if NORM == 'stream' else f.medianImage(VID, 20)
+                    I_MEDIAN[I_MEDIAN == 0] = np.mean(I_MEDIAN)
+                    SHM, MED = f.share_array(I_MEDIAN)
+                if len(todo) > 0:
+                    _, VIDEO = f.share_array(VID)
+                J = dict(job=j, frames=frames, todo=todo, SHM=SHM, VIDEO=VIDEO, MED=MED, PARAMS=PARAMS,
+                         INDEX=INDEX, results=results, done=len(frames)-len(todo), CHECK=CHECK,
+                         ready=0 if MOVING else len(todo))
+                if MOVING:
+                    J['SLOT'] = {k: i % SLOTS for i, k in enumerate(todo)}
+                    J['busy'] = np.zeros(SLOTS, dtype=bool)
+                READY.put(J)
+
+                if MOVING:
+                    # Moving median stage: frame todo[i] is sent to the workers once J['ready'] > i
+                    for k, I_MEDIAN in f.moving_median_images(VID, JOB.get('window', 40), todo, 'float32'):
+                        with BACKGROUND:
+                            while J['busy'][J['SLOT'][k]] and 'stop' not in STATE:
+                                BACKGROUND.wait(0.1)
+                        if 'stop' in STATE:
+                            return
+                        np.ndarray(I_MEDIAN.shape, dtype='float32', buffer=SHM.buf,
+                                   offset=J['SLOT'][k]*I_MEDIAN.nbytes)[:] = I_MEDIAN
+                        with BACKGROUND:
+                            J['busy'][J['SLOT'][k]] = True
+                            J['ready'] += 1
+                            BACKGROUND.notify_all()
+            except Exception as ERROR:
+                STATE['error'] = ERROR
+                return
+
+    def tasks():
+        # Round robin over the frames of the prepared jobs whose background is ready
+        ACTIVE = []
+        prepared = 0
+        while prepared < len(JOBS) or ACTIVE:
+            if 'error' in STATE or 'stop' in STATE:
+                return
+            while prepared < len(JOBS) and len(ACTIVE) < 2:
+                try:
+                    J = READY.get(block=not ACTIVE, timeout=0.1)
+                except queue.Empty:
+                    break
+                prepared += 1
+                J['start'] = time()
+                STATE[J['job']] = J
+                if len(J['todo']) == 0:
+                    FINISHED.append(J['job'])
+                    continue
+                ACTIVE.append([J, 0])
+                if 'bar' in STATE:
+                    STATE['bar'].total = (STATE['bar'].total or 0) + len(J['todo'])
+            SENT = False
+            for A in list(ACTIVE):
+                J, i = A
+                if i == len(J['todo']):
+                    ACTIVE.remove(A)
+                    continue
+                if i >= J['ready']:
+                    continue
+                A[1] += 1
+                PENDING.acquire()
+                if 'stop' in STATE:
+                    return
+                SENT = True
+                PARAMS = J['PARAMS']
+                if 'SLOT' in J:
+                    PARAMS = PARAMS[:8] + (dict(PARAMS[8], background_slot=J['SLOT'][J['todo'][i]]),)
+                yield (J['job'], (J['todo'][i], J['VIDEO'], J['MED']) + PARAMS)
+            if ACTIVE and not SENT:
+                # Waiting for the moving median stage
+                with BACKGROUND:
+                    BACKGROUND.wait(0.1)
+
+    # Workers are forked before the preparing thread starts (no locks held by it in the
+    # children) and share the resource tracker of this process
+    resource_tracker.ensure_running()
+    pool = Pool(processes)
+    THREAD = threading.Thread(target=prepare, daemon=True)
+    THREAD.start()
+    try:
+        RESULTS = pool.imap_unordered(f.positions_batch_job, tasks())
+        if progress:
+            # Total grows as the videos are prepared
+            from tqdm import tqdm
+            RESULTS = STATE['bar'] = tqdm(RESULTS, total=0)
+        for j, R in RESULTS:
+            PENDING.release()
+            J = STATE[j]
+            J['results'][J['INDEX'][R[5]]] = R
+            J['done'] += 1
+            if 'SLOT' in J:
+                # Background slot of the frame can be filled again
+                with BACKGROUND:
+                    J['busy'][J['SLOT'][R[5]]] = False
+                    BACKGROUND.notify_all()
+            if J['CHECK'] is not None:
+                c = R[5] // J['CHECK']['frames']
+                J['CHECK']['pending'][c] -= 1
+                if J['CHECK']['pending'][c] == 0:
+                    CHUNK = [r for k, r in zip(J['frames'], J['results']) if k // J['CHECK']['frames'] == c]
+                    f.save_checkpoint(os.path.join(J['CHECK']['folder'], 'chunk%06d.npz' % c),
+                                      CHUNK, J['CHECK']['params'])
+            if J['done'] == len(J['frames']):
+                yield j, f.finish_job(J, JOBS[j]['FRAME_RATE']), time() - J['start']
+            while FINISHED:
+                j = FINISHED.popleft()
+                yield j, f.finish_job(STATE[j], JOBS[j]['FRAME_RATE']), 0
+        while FINISHED:
+            # Jobs without frames to process (empty or all found in the checkpoints)
+            j = FINISHED.popleft()
+            yield j, f.finish_job(STATE[j], JOBS[j]['FRAME_RATE']), 0
+        if 'error' in STATE:
+            raise STATE['error']
+        pool.close()
+    finally:
+        # Interrupted: unblock the task generator so that the Pool can stop
+        STATE['stop'] = True
+        for _ in range(processes):
+            PENDING.release()
+        pool.terminate()
+        pool.join()
+        # Jobs prepared but not started yet
+        THREAD_ALIVE = THREAD.is_alive()
+        while THREAD_ALIVE or not READY.empty():
+            try:
+                J = READY.get(timeout=0.1)
+            except queue.Empty:
+                THREAD_ALIVE = THREAD.is_alive()
+                continue
+            if isinstance(J, dict):
+                STATE[J['job']] = J
+        for J in [STATE[j] for j in range(len(JOBS)) if j in STATE]:
+            if J['SHM'] is not None:
+                J['SHM'].close()
+                J['SHM'].unlink()
+                J['SHM'] = None
+
+#%% finish_job
+def finish_job(J, FRAME_RATE):
+    ## POSITIONS table of a finished job of detect_positions_jobs, releases its shared memory
+    import functions as f
+
+    if J['SHM'] is not None:
+        J['SHM'].close()
+        J['SHM'].unlink()
+        J['SHM'] = None
+
+    POSITIONS = f.positions_table(J['results'], FRAME_RATE)
+    POSITIONS['TIME'] = POSITIONS['TIME'].round(3)
+    POSITIONS.attrs['frames'] = len(J['frames'])
+
+    return POSITIONS
+
+#%% Checkpoints
+def save_checkpoint(path, results, params):
+    ## Saves positions_batch outputs of a chunk of frames to a npz file
+    #   Input:  path - npz file, written to path+'.part' first and then renamed
+    #        results - positions_batch outputs [X, Y, Z, I_FS, I_GS, frame]
+    #         params - dictionary of parameters of the run, stored as json
+    import os
+    import json
+    import numpy as np
+
+    DATA = {'FRAMES': np.array([r[5] for r in results], dtype='int64'),
+            'COUNTS': np.array([len(r[0][0]) for r in results], dtype='int64'),
+            '__params__': np.array(json.dumps(params, sort_keys=True, default=str))}
+    for j, c in enumerate(['X', 'Y', 'Z', 'I_FS', 'I_GS']):
+        DATA[c] = np.concatenate([np.asarray(r[j][0]) for r in results] + [np.zeros(0, dtype=np.asarray(results[0][j][0]).dtype)])
+
+    with open(path+'.part', 'wb') as fid:
+        np.savez(fid, **DATA)
+    os.replace(path+'.part', path)
+
+def load_checkpoints(folder, params):
+    ## positions_batch outputs saved by save_checkpoint in a folder
+    #   Input:  folder - checkpoint folder
+    #           params - parameters of the run, files saved with other parameters are skipped
+    #   Output: results - dictionary {frame: [X, Y, Z, I_FS, I_GS, frame]}
+    import os
+    import json
+    import numpy as np
+
+    PARAMS = json.dumps(params, sort_keys=True, default=str)
+    results = {}
+    for name in sorted(os.listdir(folder)):
+        if not name.endswith('.npz'):
+            continue
+        with np.load(os.path.join(folder, name)) as DATA:
+            if str(DATA['__params__']) != PARAMS:
+                print('Skipping checkpoint '+name+' (different parameters)')
+                continue
+            SPLIT = np.cumsum(DATA['COUNTS'])[:-1]
+            COLUMNS = [np.split(DATA[c], SPLIT) for c in ['X', 'Y', 'Z', 'I_FS', 'I_GS']]
+            for i, k in enumerate(DATA['FRAMES']):
+                results[int(k)] = [[C[i]] for C in COLUMNS] + [int(k)]
+
+    return results
+
+#%% positions_batch_job
+def positions_batch_job(TUPLE):
+    ## positions_batch_shared tagged with the job number, for detect_positions_jobs
+    #   Input: TUPLE - (job, TUPLE of positions_batch_shared)
+    #   Output: (job, output of positions_batch_shared)
+    from functions import positions_batch_shared
+
+    return TUPLE[0], positions_batch_shared(TUPLE[1])
+
+#%% positions_path
+def positions_path(PATH, scheme, THRESHOLD, PMD, SZ, NUMSTEPS, ext='.parquet'):
+    ## File name of the positions of a video, next to the video
+    import os
+
+    path, pp = os.path.split(os.path.splitext(PATH)[0])
+    
+    return os.path.join(path, pp+'_TH'+str(THRESHOLD)+'_PMD'+str(PMD)+'_SZ'+str(SZ)+'_NUMSTEPS'+str(NUMSTEPS)+'_'+scheme.strip('-')+ext)
+
+#%% save_table
+def save_table(DF, path, params=None):
+    ## Save a positions / tracks table, format from the extension
+    #   Input:   DF - DataFrame
+    #          path - .parquet, .feather (need pyarrow), .npz or .csv
+    #        params - dict of run parameters stored with the table (not for .csv)
+    #   Output: path - path written (.parquet/.feather fall back to .npz without pyarrow)
+    import os
+    import json
+    import numpy as np
+
+    EXT = os.path.splitext(path)[1].lower()
+    META = json.dumps(params if params is not None else DF.attrs, default=lambda o: o.item() if hasattr(o, 'item') else str(o))
+
+    if EXT in ['.parquet', '.feather']:
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            import pyarrow.feather as pf
+        except ImportError:
+            print('pyarrow is not installed, saving as npz')
+            EXT = '.npz'
+            path = os.path.splitext(path)[0] + EXT
+        else:
+            TABLE = pa.Table.from_pandas(DF, preserve_index=False)
+            TABLE = TABLE.replace_schema_metadata({**(TABLE.schema.metadata or {}), b'params': META.encode()})
+            if EXT == '.parquet':
+                pq.write_table(TABLE, path)
+            else:
+                pf.write_feather(TABLE, path)
+            return path
+
+    if EXT == '.npz':
+        COLUMNS = {'__columns__': np.array(DF.columns, dtype=str), '__params__': np.array(META)}
+        for j, c in enumerate(DF.columns):
+            COLUMNS['c' + str(j)] = DF[c].to_numpy()
+        np.savez(path, **COLUMNS)
+    elif EXT == '.csv':
+        DF.to_csv(path, index=False)
+    else:
+        raise ValueError('Unknown table format: ' + EXT)
+
+    return path
+
+#%% load_table
+def load_table(path):
+    ## Load a table saved with save_table (or a CSV from older versions)
+    #   Input:  path - .parquet, .feather, .npz or .csv
+    #   Output:   DF - DataFrame, run parameters in DF.attrs
+    import os
+    import json
+    import numpy as np
+    import pandas as pd
+
+    EXT = os.path.splitext(path)[1].lower()
+    META = '{}'
+
+    if EXT in ['.parquet', '.feather']:
+        import pyarrow.parquet as pq
+        import pyarrow.feather as pf
+
+        TABLE = pq.read_table(path) if EXT == '.parquet' else pf.read_table(path)
+        META = (TABLE.schema.metadata or {}).get(b'params', b'{}').decode()
+        DF = TABLE.to_pandas()
+    elif EXT == '.npz':
+        with np.load(path) as DATA:
+            META = str(DATA['__params__'])
+            DF = pd.DataFrame({c: DATA['c' + str(j)] for j, c in enumerate(DATA['__columns__'])})
+    elif EXT == '.csv':
+        DF = pd.read_csv(path)
+        # Index column written by older to_csv calls
+        if DF.columns[0].startswith('Unnamed: 0'):
+            DF = DF.drop(columns=DF.columns[0])
+    else:
+        raise ValueError('Unknown table format: ' + EXT)
+
+    DF.attrs.update(json.loads(META))
+
+    return DF
+
 #%% Clean tracks with Search Sphere
 def clean_tracks_search_sphere(track, rsphere):
     import numpy as np
@@ -1082,25 +2344,38 @@ def clean_tracks_search_sphere(track, rsphere):
     
 #%% Search Sphere tracking
 def search_sphere_tracking(DF, rsphere, frame_skip, min_size):
+    ## Tracks from the detections of frame 0, following the closest detection in the next frames
+    # Detections are grouped by frame once (rows sorted by FRAME, with the offsets of each
+    # frame) and each frame gets a cKDTree, so the closest detection is found in O(log n)
+    # instead of filtering the whole table for every particle and frame.
+    #   Input:  DF - DataFrame with X, Y, Z, TIME, FRAME (detections of frame 0 first)
+    #      rsphere - search radius
+    #   frame_skip - number of consecutive frames without detection in the sphere before
+    #                the track is ended
+    #     min_size - tracks with min_size detections or less are discarded
+    #   Output: tt - DataFrame with X, Y, Z, TIME, FRAME, PARTICLE
     import numpy as np
     import pandas as pd
     from tqdm import tqdm
-    from functions import contiguous_repeats
-    from time import time
+    from scipy.spatial import cKDTree
     
     # rsphere = 15
     # frame_skip = 10
     # min_size = 200
 
-    dd = DF[DF['FRAME'] == 0]
-    frames = np.unique(DF['FRAME'])
-
     dd = DF
     dd = dd.reset_index(drop=True)
     frames = np.unique(dd['FRAME'])
     num_particles = len(dd[dd['FRAME'] == 0])
     num_particles = int(num_particles)
 
+    # Detections grouped by frame, in table order within each frame
+    ORDER = np.argsort(dd['FRAME'].values, kind='stable')
+    DATA = dd[['X', 'Y', 'Z', 'TIME', 'FRAME']].values.astype('float64')[ORDER]
+    START = np.searchsorted(DATA[:, 4], np.arange(len(frames)), side='left')     # Frames 0, 1, ... len(frames)-1
+    END = np.searchsorted(DATA[:, 4], np.arange(len(frames)), side='right')
+    TREES = [cKDTree(DATA[START[k]:END[k], :3]) if END[k] > START[k] else None for k in range(len(frames))]
+
     tracks = []
     for n in tqdm(range(num_particles)):
 
@@ -1111,15 +2386,20 @@ def search_sphere_tracking(DF, rsphere, frame_skip, min_size):
         frame_skip_counter = 0
         
         for k in range(1, len(frames)):
-            s = DF[DF['FRAME'] == k]
-            x, y, z, tt, fr = s['X'].values, s['Y'].values, s['Z'].values, s['TIME'].values, s['FRAME'].values
-            
-            dist = np.sqrt((x-x0)**2+(y-y0)**2+(z-z0)**2)
+            found = False
+            if TREES[k] is not None:
+                # A few nearest candidates, the distance is computed as before and the first
+                # detection of the frame wins ties
+                _, ID = TREES[k].query([x0, y0, z0], k=min(4, TREES[k].n))
+                ID = np.sort(np.atleast_1d(ID)) + START[k]
+                x, y, z = DATA[ID, 0], DATA[ID, 1], DATA[ID, 2]
+                dist = np.sqrt((x-x0)**2+(y-y0)**2+(z-z0)**2)
+                found = (dist<rsphere).any()
             
-            if (dist<rsphere).any():
-                id_min = np.where(dist == dist.min())[0][0]
-                track.append((x[id_min], y[id_min], z[id_min], tt[id_min], fr[id_min], n))
-                x0, y0, z0 = x[id_min], y[id_min], z[id_min]
+            if found:
+                id_min = ID[np.where(dist == dist.min())[0][0]]
+                track.append(tuple(DATA[id_min]) + (n,))
+                x0, y0, z0 = DATA[id_min, :3]
                 frame_skip_counter = 0
             else:
                 frame_skip_counter += 1
@@ -1205,9 +2485,16 @@ def search_sphere_tracking(DF, rsphere, frame_skip, min_size):
 
 #%%
 def search_sphere_clean(DF, rsphere, frame_skip, min_size):
+    ## Split a track with repeated frames into sub-tracks with a search sphere
+    # Rows are walked in order on arrays, the rows taken by a sub-track are marked as consumed
+    # instead of dropped from the DataFrame. The frame skip counter is shared by all sub-tracks.
+    #   Input:  DF - track with X, Y, Z, I_FS, I_GS, FRAME, TIME, PARTICLE
+    #      rsphere - largest distance between consecutive rows of a sub-track
+    #   frame_skip - rows a sub-track can miss before it is ended
+    #     min_size - sub-tracks with less rows are discarded
+    #   Output: DataFrame of the sub-tracks (PARTICLE + 0.1*(n+1)), [] if none
     import numpy as np
     import pandas as pd
-    from tqdm import tqdm
     
     # rsphere = 15
     # frame_skip = 10
@@ -1215,7 +2502,6 @@ def search_sphere_clean(DF, rsphere, frame_skip, min_size):
     
     dd = DF
     dd = dd.reset_index(drop=True)
-    frames = np.unique(dd['FRAME'])
     particle = dd['PARTICLE'][0]
     # num_particles = len(dd[dd['FRAME'] == 0])
     num_particles = contiguous_repeats(dd['FRAME'].values).max()  # Asume that repeated values mean new particle
@@ -1226,44 +2512,181 @@ def search_sphere_clean(DF, rsphere, frame_skip, min_size):
         return dd
     
     else:
+        VALUES = dd[['X', 'Y', 'Z', 'I_FS', 'I_GS', 'FRAME', 'TIME']].to_numpy(dtype='float64')
+        x, y, z, t = dd['X'].values, dd['Y'].values, dd['Z'].values, dd['TIME'].values
+        CONSUMED = np.zeros(len(dd), dtype=bool)
+        
         tracks = []
         for n in range(num_particles):
-    
-            idtrack = []    
-            for i in range(len(dd)):
-                
-                if i==0:
-                    x0, y0, z0, i_fs0, i_gs0, fr0, t0 = dd['X'][i], dd['Y'][i], dd['Z'][i], dd['I_FS'][i], dd['I_GS'][i], dd['FRAME'][i], dd['TIME'][i]
-                    track = [(x0, y0, z0, i_fs0, i_gs0, fr0, t0, particle+0.1*(n+1))]
-                    idtrack.append(i)
-                    
-                    
-                else:
-                    x, y, z, i_fs, i_gs, fr, t = dd['X'][i], dd['Y'][i], dd['Z'][i], dd['I_FS'][i], dd['I_GS'][i], dd['FRAME'][i], dd['TIME'][i]
-                    dist = np.sqrt((x-x0)**2+(y-y0)**2+(z-z0)**2)
+            
+            ROWS = np.flatnonzero(~CONSUMED)
+            if len(ROWS) > 0:
+                idtrack = [ROWS[0]]
+                i0 = ROWS[0]
+                p = 1
+                while p < len(ROWS):
+                    # Only the rows up to the one that would exceed frame_skip need to be checked
+                    left = frame_skip - frame_skip_counter
+                    W = len(ROWS) - p if left >= len(ROWS) - p else max(int(np.floor(left)), 0) + 1
+                    C = ROWS[p:p+W]
+                    dist = np.sqrt((x[C]-x[i0])**2+(y[C]-y[i0])**2+(z[C]-z[i0])**2)
+                    MATCH = np.flatnonzero((dist < rsphere) & (np.abs(t[C]-t[i0]) > 0))
                     
-                    if dist < rsphere and abs(t-t0)>0:
-                        track.append((x, y, z, i_fs, i_gs, fr, t, particle+0.1*(n+1)))
-                        idtrack.append(i)
-                        x0, y0, z0, i_fs0, i_gs0, fr0, t0 = x, y, z, i_fs, i_gs, fr, t
+                    if len(MATCH) > 0:
+                        i0 = C[MATCH[0]]
+                        idtrack.append(i0)
                         frame_skip_counter = 0
+                        p += MATCH[0] + 1
                     else:
-                        frame_skip_counter += 1
+                        frame_skip_counter += len(C)
                         if frame_skip_counter > frame_skip:
                             break
-            if len(track) >= min_size:
-                t = pd.DataFrame(np.array(track), columns=['X', 'Y', 'Z', 'I_FS', 'I_GS', 'FRAME', 'TIME', 'PARTICLE'])
-                tracks.append(t)
+                        p += len(C)
                 
-            dd = dd.drop(idtrack)
-            dd = dd.reset_index(drop=True)
+                track = np.column_stack((VALUES[idtrack], particle+0.1*(n+1)*np.ones(len(idtrack))))
+                CONSUMED[idtrack] = True
+            
+            if len(track) >= min_size:
+                tracks.append(pd.DataFrame(track, columns=['X', 'Y', 'Z', 'I_FS', 'I_GS', 'FRAME', 'TIME', 'PARTICLE']))
            
-            if len(dd)<min_size:
+            if (~CONSUMED).sum() < min_size:
                 break
             
         return pd.concat(tracks) if len(tracks) > 0 else []
 
 
+#%% Frame linking
+def link_tracks(DF, rsphere, frame_skip, min_size, method='greedy'):
+    ## Tracks from all the detections, linking all the active tracks together frame by frame
+    # For every frame, the detections within rsphere of the last position of each active
+    # track are found with one cKDTree query for all tracks. Each track takes at most one
+    # detection and each detection goes to at most one track. Detections left over start
+    # new tracks, and tracks without detection for more than frame_skip frames are ended.
+    #   Input:  DF - DataFrame with X, Y, Z, FRAME (and TIME, I_FS, I_GS)
+    #      rsphere - largest distance between consecutive detections of a track
+    #   frame_skip - frames a track can miss before it is ended
+    #     min_size - tracks with min_size detections or less are discarded
+    #       method - 'greedy' (closest pairs first) or 'hungarian' (most links with the lowest
+    #                total distance, solved separately for each group of tracks and detections
+    #                that compete for each other), see match_pairs
+    #   Output: LINKED - DF rows of the tracks with a PARTICLE column, sorted by PARTICLE and FRAME
+    import numpy as np
+    from scipy.spatial import cKDTree
+    
+    dd = DF.reset_index(drop=True)
+    POS = dd[['X', 'Y', 'Z']].values.astype('float64')
+    FRAMES = dd['FRAME'].values
+    ORDER = np.argsort(FRAMES, kind='stable')
+    BOUNDS = np.flatnonzero(np.diff(FRAMES[ORDER])) + 1
+    
+    LABEL = np.full(len(dd), -1)
+    LAST = []           # Row of the last detection of each track
+    ACTIVE = []         # Tracks that can still be continued
+    for ROWS in np.split(ORDER, BOUNDS):
+        if len(ROWS) == 0:
+            continue
+        k = FRAMES[ROWS[0]]
+        
+        # Tracks with more than frame_skip missing frames are ended
+        ACTIVE = [t for t in ACTIVE if k - FRAMES[LAST[t]] - 1 <= frame_skip]
+        
+        TRACK, DET = np.zeros(0, dtype='int'), np.zeros(0, dtype='int')
+        if len(ACTIVE) > 0:
+            # Candidate (track, detection) pairs closer than rsphere
+            PAIRS = cKDTree(POS[[LAST[t] for t in ACTIVE]]).sparse_distance_matrix(
+                cKDTree(POS[ROWS]), rsphere, output_type='ndarray')
+            PAIRS = PAIRS[PAIRS['v'] < rsphere]
+            TRACK, DET = match_pairs(PAIRS['i'], PAIRS['j'], PAIRS['v'], method)
+        
+        for i, j in zip(TRACK, DET):
+            t = ACTIVE[i]
+            LABEL[ROWS[j]] = t
+            LAST[t] = ROWS[j]
+        
+        # Births
+        NEW = np.setdiff1d(np.arange(len(ROWS)), DET)
+        LABEL[ROWS[NEW]] = len(LAST) + np.arange(len(NEW))
+        LAST.extend(ROWS[NEW])
+        ACTIVE.extend(range(len(LAST) - len(NEW), len(LAST)))
+    
+    # Tracks longer than min_size, numbered in order of appearance
+    SIZES = np.bincount(LABEL, minlength=len(LAST))
+    KEEP = SIZES > min_size
+    NUMBER = np.cumsum(KEEP) - 1
+    ROWS = np.flatnonzero(KEEP[LABEL])
+    
+    LINKED = dd.iloc[ROWS].copy()
+    LINKED['PARTICLE'] = NUMBER[LABEL[ROWS]]
+    LINKED = LINKED.sort_values(['PARTICLE', 'FRAME'], kind='stable').reset_index(drop=True)
+    
+    return LINKED
+
+def match_pairs(I, J, COST, method='greedy'):
+    ## One to one matching of the candidate pairs (I[n], J[n]) with cost COST[n]
+    #   Input: I, J - indices of the candidate pairs
+    #          COST - cost of each pair
+    #        method - 'greedy': lowest cost pairs first (ties by I, then J)
+    #                 'hungarian': as many pairs as possible with the lowest total cost,
+    #                 linear_sum_assignment on each connected component of the pairs
+    #   Output: I, J - matched pairs
+    import numpy as np
+    
+    I, J, COST = np.asarray(I, dtype='int'), np.asarray(J, dtype='int'), np.asarray(COST, dtype='float64')
+    
+    if method == 'hungarian':
+        from scipy.sparse import coo_matrix
+        from scipy.sparse.csgraph import connected_components
+        from scipy.optimize import linear_sum_assignment
+        
+        if len(I) == 0:
+            return I, J
+        
+        # Bipartite graph of the pairs, I nodes first and then J nodes
+        UI, II = np.unique(I, return_inverse=True)
+        UJ, JJ = np.unique(J, return_inverse=True)
+        NODES = len(UI) + len(UJ)
+        GRAPH = coo_matrix((np.ones(len(I)), (II, len(UI) + JJ)), shape=(NODES, NODES))
+        _, COMPONENT = connected_components(GRAPH, directed=False)
+        COMPONENT = COMPONENT[II]
+        
+        # Components with a single pair are matched directly
+        PAIRS_PER = np.bincount(COMPONENT)
+        SINGLE = PAIRS_PER[COMPONENT] == 1
+        MI, MJ = [I[SINGLE]], [J[SINGLE]]
+        
+        ORDER = np.flatnonzero(~SINGLE)
+        ORDER = ORDER[np.argsort(COMPONENT[ORDER], kind='stable')]
+        for P in np.split(ORDER, np.flatnonzero(np.diff(COMPONENT[ORDER])) + 1):
+            if len(P) == 0:
+                continue
+            ROWS, R = np.unique(II[P], return_inverse=True)
+            COLS, C = np.unique(JJ[P], return_inverse=True)
+            # Missing pairs cost more than all the pairs of the component together
+            BIG = COST[P].sum() + 1
+            M = np.full((len(ROWS), len(COLS)), BIG)
+            M[R, C] = COST[P]
+            ROW, COL = linear_sum_assignment(M)
+            OK = M[ROW, COL] < BIG
+            MI.append(UI[ROWS[ROW[OK]]])
+            MJ.append(UJ[COLS[COL[OK]]])
+        
+        return np.concatenate(MI), np.concatenate(MJ)
+    
+    if method != 'greedy':
+        raise ValueError('Unknown method '+str(method))
+    
+    USED_I, USED_J = set(), set()
+    MI, MJ = [], []
+    for n in np.lexsort((J, I, COST)):
+        if I[n] not in USED_I and J[n] not in USED_J:
+            USED_I.add(I[n])
+            USED_J.add(J[n])
+            MI.append(I[n])
+            MJ.append(J[n])
+    
+    return np.array(MI, dtype='int'), np.array(MJ, dtype='int')
+
+
 #%% get_turns
 # def get_turns(data):
     
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Command line entry point of the holography pipeline (no GUI needed).
+
+    python holography.py detect video1.avi video2.avi --scheme RS --mpp 20 --threshold 0.1
+    python holography.py detect *.avi --config params.yaml --processes 32
+
+Parameters can be given as flags or in a YAML/JSON config file (same names as
+the flags, e.g. numsteps: 150), flags override the config file.
+"""
+#%% Import libraries
+import os
+import sys
+import json
+import shutil
+import argparse
+import functions as f
+
+
+#%% Defaults (same as positions_batch_multiprocess.py)
+DEFAULTS = {'scheme': 'RS',
+            'n': 1.3226,
+            'wavelength': 0.642,
+            'mpp': 10,
+            'sz': 10.0,
+            'numsteps': 150,
+            'threshold': 0.1,
+            'pmd': 20,
+            'frame_rate': 50,
+            'invert': False,
+            'normalization': 'median',
+            'window': 40,
+            'first_frame': 0,
+            'num_frames': None,
+            'dtype': 'float64',
+            'stream': False,
+            'backend': 'numpy',
+            'workers': None,
+            'processes': None,
+            'format': 'parquet',
+            'output_dir': None,
+            'cache_dir': None,
+            'checkpoint_frames': 100,
+            'resume': False}
+
+
+#%% Config files
+def read_config(path):
+    ## YAML or JSON config file as a dictionary
+    with open(path) as fid:
+        if os.path.splitext(path)[1].lower() in ['.yaml', '.yml']:
+            import yaml
+            CONFIG = yaml.safe_load(fid) or {}
+        else:
+            CONFIG = json.load(fid)
+
+    # Accept dashes as in the flags (frame-rate) as well as underscores
+    CONFIG = {key.replace('-', '_'): value for key, value in CONFIG.items()}
+    UNKNOWN = set(CONFIG) - set(DEFAULTS)
+    if UNKNOWN:
+        raise ValueError('Unknown parameters in '+path+': '+', '.join(sorted(UNKNOWN)))
+
+    return CONFIG
+
+
+#%% Command line
+def parser():
+    PARSER = argparse.ArgumentParser(prog='holography', description='Holographic microscopy 3D detection')
+    SUB = PARSER.add_subparsers(dest='command', required=True)
+
+    # Flags have no default so that config file values are only overridden when given
+    D = SUB.add_parser('detect', help='3D positions of the particles in holographic videos',
+                       argument_default=argparse.SUPPRESS)
+    D.add_argument('videos', nargs='+', help='video files')
+    D.add_argument('--config', help='YAML or JSON file with parameters')
+    D.add_argument('--scheme', choices=['RS', 'MOD'], help='Rayleigh-Sommerfeld or modified propagator (RS)')
+    D.add_argument('--n', type=float, help='refraction index of media (1.3226)')
+    D.add_argument('--wavelength', type=float, help='wavelength in um (0.642)')
+    D.add_argument('--mpp', type=int, help='magnification (10)')
+    D.add_argument('--sz', type=float, help='step size in um (10)')
+    D.add_argument('--numsteps', type=int, help='number of steps (150)')
+    D.add_argument('--threshold', type=float, help='gradient stack threshold (0.1)')
+    D.add_argument('--pmd', type=int, help='peak min distance (20)')
+    D.add_argument('--frame-rate', dest='frame_rate', type=float, help='frame rate (50)')
+    D.add_argument('--invert', action='store_true', help='invert video')
+    D.add_argument('--normalization', choices=['median', 'stream', 'moving'],
+                   help='background: median of 20 frames, median of all frames or moving median (median)')
+    D.add_argument('--window', type=int, help='frames of the moving median (40)')
+    D.add_argument('--first-frame', dest='first_frame', type=int, help='first frame to process (0)')
+    D.add_argument('--num-frames', dest='num_frames', type=int, help='number of frames to process (all)')
+    D.add_argument('--dtype', choices=['float64', 'float32'], help='propagation precision (float64)')
+    D.add_argument('--stream', action='store_true', help='low memory streaming')
+    D.add_argument('--backend', choices=['numpy', 'scipy', 'pyfftw'], help='FFT backend (numpy)')
+    D.add_argument('--workers', type=int, help='FFT threads per process (scipy and pyfftw backends)')
+    D.add_argument('--processes', type=int, help='number of processes (all cores)')
+    D.add_argument('--format', choices=['parquet', 'feather', 'npz', 'csv'], help='output format (parquet)')
+    D.add_argument('--output-dir', dest='output_dir', help='directory for the results (next to the videos)')
+    D.add_argument('--cache-dir', dest='cache_dir', help='directory for the decoded frames (next to the videos)')
+    D.add_argument('--checkpoint-frames', dest='checkpoint_frames', type=int,
+                   help='frames per checkpoint file, 0 disables checkpoints (100)')
+    D.add_argument('--resume', action='store_true', help='skip the frames found in the checkpoints of a previous run')
+
+    return PARSER
+
+
+#%% detect
+def detect(ARGS):
+    ARGS = vars(ARGS)
+    VIDEOS = ARGS.pop('videos')
+    PARAMS = dict(DEFAULTS)
+    if 'config' in ARGS:
+        PARAMS.update(read_config(ARGS.pop('config')))
+    PARAMS.update(ARGS)
+    PARAMS.pop('command', None)
+
+    scheme = '-'+PARAMS['scheme']+'-'
+    options = {'dtype': PARAMS['dtype'], 'stream': PARAMS['stream'],
+               'backend': PARAMS['backend'], 'workers': PARAMS['workers']}
+
+    JOBS = []
+    EXPATH = []
+    for PATH in VIDEOS:
+        expath = f.positions_path(PATH, scheme, PARAMS['threshold'], PARAMS['pmd'], PARAMS['sz'],
+                                  PARAMS['numsteps'], '.'+PARAMS['format'])
+        if PARAMS['output_dir'] is not None:
+            expath = os.path.join(PARAMS['output_dir'], os.path.split(expath)[-1])
+        EXPATH.append(expath)
+
+        # Results are checkpointed next to the output file while the video is processed
+        CHECKPOINT = os.path.splitext(expath)[0]+'_checkpoints' if PARAMS['checkpoint_frames'] else None
+        JOBS.append(dict(PATH=PATH, scheme=scheme, N=PARAMS['n'], LAMBDA=PARAMS['wavelength'], MPP=PARAMS['mpp'],
+                         SZ=PARAMS['sz'], NUMSTEPS=PARAMS['numsteps'], THRESHOLD=PARAMS['threshold'],
+                         PMD=PARAMS['pmd'], FRAME_RATE=PARAMS['frame_rate'], invert=PARAMS['invert'],
+                         normalization=PARAMS['normalization'], window=PARAMS['window'],
+                         first_frame=PARAMS['first_frame'], frames=PARAMS['num_frames'], options=options,
+                         checkpoint=CHECKPOINT, checkpoint_frames=PARAMS['checkpoint_frames'],
+                         resume=PARAMS['resume'], cache_dir=PARAMS['cache_dir']))
+
+    # One Pool for all the videos, finished files are exported as they come. The videos are
+    # decoded by detect_positions_jobs, the next one while the current one is processed
+    for k, POSITIONS, T in f.detect_positions_jobs(JOBS, processes=PARAMS['processes'],
+                                                   progress=sys.stderr.isatty()):
+        PATH = VIDEOS[k]
+        expath = f.save_table(POSITIONS, EXPATH[k], dict(PARAMS, video=PATH))
+        if JOBS[k]['checkpoint'] is not None:
+            shutil.rmtree(JOBS[k]['checkpoint'])
+
+        NF = POSITIONS.attrs['frames']
+        print('File '+str(k+1)+' of '+str(len(VIDEOS))+': '+os.path.split(PATH)[-1])
+        print('%d frames, %d detections in %.1f s (%.2f frames/s)' % (NF, len(POSITIONS), T, NF/T if T > 0 else 0))
+        print('Exported to: ', expath)
+
+
+#%% Main
+if __name__ == '__main__':
+    ARGS = parser().parse_args()
+
+    if ARGS.command == 'detect':
+        detect(ARGS)
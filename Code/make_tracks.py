@@ -18,12 +18,12 @@ import sklearn.cluster as cl
 import time
 import easygui as gui
 import hdbscan
-from scipy.optimize import linear_sum_assignment
 # from hungarian_algorithm import algorithm
 from tqdm import tqdm
 
 PATH = gui.fileopenbox(default='/media/erick/NuevoVol/LINUX_LAP/PhD/Thesis/Results/1/')
-DF = pd.read_csv(PATH)
+DF = f.load_table(PATH)
+BASE, EXT = os.path.splitext(PATH)    # Results saved in the same format as the input
 DF = DF[['X','Y','Z','I_FS','I_GS','FRAME', 'TIME']]
 DF.index = np.arange(len(DF))
 D = DF.values
@@ -33,7 +33,7 @@ D = DF.values
 # KMeans, DBSCAN or HA
 # method = 'DBSCAN'
 method = gui.choicebox(msg='Choose a tracking Algorithm', title='Choose',
-                       choices=['Search Sphere', 'KMeans', 'DBSCAN', 'HDBSCAN']) #choices=['KMeans', 'DBSCAN', 'HA', 'HDBSCAN'])
+                       choices=['Search Sphere', 'Frame Linking', 'HA', 'KMeans', 'DBSCAN', 'HDBSCAN'])
 
 if method == 'Search Sphere':
     rsphere, frame_skip, min_size = gui.multenterbox(msg='Search Sphere parameters',
@@ -47,6 +47,19 @@ if method == 'Search Sphere':
     print(rsphere, frame_skip, min_size)
     print(time.time()-t_sphere)
 
+elif method == 'Frame Linking':
+    # All tracks advanced together, particles appearing after frame 0 are also tracked
+    rsphere, frame_skip, min_size = gui.multenterbox(msg='Frame Linking parameters',
+                            title='Frame Linking parameters',
+                            fields=['Radius (e.g. 5):',
+                                    'Max Frame Skip (5)',
+                                    'MIN SAMPLES (e.g. 10):'])
+    
+    t_link = time.time()
+    LINKED = f.link_tracks(DF, float(rsphere), float(frame_skip), float(min_size))
+    print(rsphere, frame_skip, min_size)
+    print(time.time()-t_link)
+
 elif method == 'KMeans':
 
     #% K-Means for track detection
@@ -88,43 +101,17 @@ elif method == 'HDBSCAN':
 
 elif method == 'HA':
 
-    #% Hungrian algorithm
-    T0_HA = time.time()
-    FRAME_DATA = np.empty(int(DF['FRAME'].max()), dtype=object)
-    SIZE = np.empty(FRAME_DATA.shape[0])
-    for i in range(FRAME_DATA.shape[0]):
-        FRAME_DATA[i] = D[D[:, 5] == i]
-        SIZE[i] = FRAME_DATA[i].shape[0]
-        
-    TRACKS = [FRAME_DATA[0]]
-    sizes = np.empty(len(FRAME_DATA), dtype='int')
-    sizes[0] = len(FRAME_DATA[0])
-    
-    for k in range(len(FRAME_DATA)-1):  
-        print(k)            
-        R1 = FRAME_DATA[k]
-        R2 = FRAME_DATA[k+1]
-        
-        x2, x1 = np.meshgrid(R2[:, 0], R1[:, 0])
-        y2, y1 = np.meshgrid(R2[:, 1], R1[:, 1])
-        z2, z1 = np.meshgrid(R2[:, 2], R1[:, 2])        
-        COST = np.sqrt((x2-x1)**2 + (y2-y1)**2 + (z2-z1)**2)
-        row_ind, particle_index = linear_sum_assignment(COST)
-        sizes[k+1] = len(particle_index)
-        TRACKS.append(R2[particle_index, :])
-    
-    #%
-    TRACK = np.vstack(TRACKS)
-    TR = pd.DataFrame(TRACK, columns=['X', 'Y', 'Z', 'I_FS', 'I_GS', 'FRAME', 'TIME'])
-    
-    particle_column = []
-    for i in range(len(sizes)):
-        particle_column.append(np.arange(sizes[i]))    
+    #% Hungrian algorithm, each frame linked to the tracks within the max distance
+    rsphere, frame_skip, min_size = gui.multenterbox(msg='Hungarian parameters',
+                            title='Hungarian parameters',
+                            fields=['Max distance (e.g. 5):',
+                                    'Max Frame Skip (5)',
+                                    'MIN SAMPLES (e.g. 10):'])
     
-    particle_column = np.concatenate(particle_column, axis=0)
-    TR['PARTICLE'] = particle_column
-    LINKED = TR
+    T0_HA = time.time()
+    LINKED = f.link_tracks(DF, float(rsphere), float(frame_skip), float(min_size), method='hungarian')
     T_HA = time.time() - T0_HA
+    print(rsphere, frame_skip, min_size)
     print(T_HA)
 
 LINKED = LINKED[LINKED.PARTICLE != -1]
@@ -184,7 +171,7 @@ LINKED = pd.concat(tracks)
 # LINKED = LL.copy()
 print(time.time()-t_clean)
 
-LINKED.to_csv(PATH[:-4]+'_LINKED_'+method+'_'+'cleaned.csv', index=False)
+f.save_table(LINKED, BASE+'_LINKED_'+method+'_'+'cleaned'+EXT, dict(DF.attrs, method=method))
 #%% Smooth trajectories
 spline_degree = 3  # 3 for cubic spline
 smoothing_condition = 0.85
@@ -213,7 +200,7 @@ smoothed_curves_df = pd.DataFrame(smoothed_curves, columns=['X', 'Y' ,'Z', 'TIME
 T_smooth = time.time() - T0_smooth
 print(T_smooth)
 
-# smoothed_curves_df.to_csv(PATH[:-4]+'_'+method+'_smoothed_'+str(smoothing_condition)+'.csv', index=False)
+# f.save_table(smoothed_curves_df, BASE+'_'+method+'_smoothed_'+str(smoothing_condition)+EXT)
 
 #%% MSD
 T_MSD = time.time()
@@ -233,7 +220,8 @@ for p in tqdm(particle_num):
 
 print(time.time()-T_MSD)
 
-smoothed_curves_df.to_csv(PATH[:-4]+'_'+method+'_smoothed_'+str(smoothing_condition)+'.csv', index=False)
+f.save_table(smoothed_curves_df, BASE+'_'+method+'_smoothed_'+str(smoothing_condition)+EXT,
+             dict(DF.attrs, method=method, smoothing_condition=smoothing_condition))
 
 #%% Matplotlib scatter plot to compare detected points with smoothed curve
 # 3D Scatter Plot
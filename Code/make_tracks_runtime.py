@@ -18,12 +18,11 @@ import sklearn.cluster as cl
 import time
 import easygui as gui
 import hdbscan
-from scipy.optimize import linear_sum_assignment
 from hungarian_algorithm import algorithm
 
 PATH = gui.fileopenbox(default='/media/erick/NuevoVol/LINUX_LAP/PhD/')
 # DF = pd.read_csv(PATH, index_col=0)
-DF = pd.read_csv(PATH)
+DF = f.load_table(PATH)
 DF = DF.head(1000000)
 
 # DF = pd.read_csv('/home/erick/Documents/PhD/Colloids/20x_50Hz_100us_642nm_colloids_2000frames_2000frames_rayleighSommerfeld_Results.csv', index_col=0)
@@ -41,6 +40,12 @@ D = DF.values
 # method = 'DBSCAN'
 plot_results = False
 
+# Hungarian linking: max distance between linked detections, frames a track can miss
+# and smallest track kept (0 keeps every track, as the old HA did)
+rsphere = 5
+frame_skip = 5
+min_size = 0
+
 
 #%% K-Means for track detection
 DF_KMeans = DF.copy()
@@ -143,56 +148,7 @@ print('Smooth DBSCAN',T0_smooth_DBSCAN, T0_smooth_DBSCAN + T_smooth_DBSCAN, T_sm
 #%% Hungrian algorithm
 DF_HA = DF.copy()
 T0_HA = time.time()
-FRAME_DATA = np.empty(int(DF_HA['FRAME'].max()), dtype=object)
-SIZE = np.empty(FRAME_DATA.shape[0])
-for i in range(FRAME_DATA.shape[0]):
-    FRAME_DATA[i] = D[D[:, 5] == i]
-    SIZE[i] = FRAME_DATA[i].shape[0]    
-
-# particle_index = np.empty((int(SIZES[0]), len(FRAME_DATA)), dtype='int')
-TRACKS = [FRAME_DATA[0]]
-sizes = np.empty(len(FRAME_DATA), dtype='int')
-sizes[0] = len(FRAME_DATA[0])
-for k in range(len(FRAME_DATA)-1):  
-    # print(k)
-    
-    if k==0:    
-        R1 = FRAME_DATA[k]
-        R2 = FRAME_DATA[k+1]
-    else:
-        R1 = TRACKS[k]
-        R2 = FRAME_DATA[k+1]
-    
-    # COST = np.empty((int(SIZE.max()), int(SIZE.max())))
-    COST = np.empty((len(R1), len(R2)))
-    # for i in range(int(SIZE.max())):
-    #     for j in range(int(SIZE.max())):        
-            
-    for i in range(len(R1)):
-        for j in range(len(R2)):
-            
-            COST[i, j] = np.sqrt(sum((R1[i, :3]- R2[j, :3])**2))      
-    # row_ind, particle_index[:, k] = linear_sum_assignment(COST)
-    row_ind, particle_index = linear_sum_assignment(COST)
-    sizes[k+1] = len(particle_index)
-    # print(len(particle_index))
-    # TRACKS.append(R2[particle_index[:, k], :])
-    TRACKS.append(R2[particle_index, :])
-
-# print(time.time() - T0)
-
-#%
-TRACK = np.vstack(TRACKS)
-TR = pd.DataFrame(TRACK, columns=['X', 'Y', 'Z', 'I_FS', 'I_GS', 'FRAME'])
-# TR['PARTICLE'] = np.tile(np.arange(SIZES[0]), len(TRACKS))
-
-particle_column = []
-for i in range(len(sizes)):
-    particle_column.append(np.arange(sizes[i]))    
-
-particle_column = np.concatenate(particle_column, axis=0)
-TR['PARTICLE'] = particle_column
-LINKED_HA = TR
+LINKED_HA = f.link_tracks(DF_HA, rsphere, frame_skip, min_size, method='hungarian')
 T_HA = time.time() - T0_HA
 PARTICLES_HA = LINKED_HA['PARTICLE'].unique().shape[0]
 print('HA',T0_HA, T0_HA + T_HA, T_HA)
@@ -203,8 +159,8 @@ if plot_results == True:
     fig3 = plt.figure(3)
     ax3 = Axes3D(fig3)
     A = LINKED_HA.__array__()
-    A = LINKED_HA[LINKED_HA.PARTICLE != -1].values
-    p3 = ax3.scatter(A[:, 0], A[:, 1], A[:, 2], s=1, marker='o', c=A[:, 6])
+    A = LINKED_HA[LINKED_HA.PARTICLE != -1]
+    p3 = ax3.scatter(A.X, A.Y, A.Z, s=1, marker='o', c=A.PARTICLE)
     fig3.colorbar(p3)
     plt.show(fig3)
 
@@ -140,7 +140,7 @@ for k in tqdm(range(VID.shape[-1])):
     # GS[GS < THRESHOLD] = 0
     LOCS = np.empty((1, 3), dtype=object)
     LOCS[0, 0] = f.positions3D(GS, peak_min_distance=20, num_particles='None', MPP=MPP)  # , peak_min_distance, num_particles, MP
-    A = LOCS[0, 0].astype('int')
+    A = f.yxz_index(LOCS[0, 0], GS.shape)
     # LOCS[0, 1] = IM[A[:, 0], A[:, 1], A[:, 2]]
     LOCS[0, 1] = GS[A[:, 0], A[:, 1], A[:, 2]]        #LOCS are in pixels, still need o be converteed to um
     LOCS[0, 2] = GS[A[:, 0], A[:, 1], A[:, 2]]
@@ -25,25 +25,13 @@ for k in tqdm(range(nk)):
     vidn[:, :, k] = VID[:, :, k] / med
 
 #%% Normalize with moving mean image
+# Median of the 2*nframes frames around each frame, histograms updated as the window moves
 nframes = 20
 vid_norm = np.empty_like(VID)
 
-for k in tqdm(range(nk)):
-    
-    if k <= nframes:
-        median = np.median(VID[:, :, :nframes], axis=2)
-        median[median == 0] = np.mean(median)
-        vid_norm[:, :, k] = VID[:, :, k] / median
-        
-    elif k >= nk-nframes:
-        median = np.median(VID[:, :, nk-nframes:nk], axis=2)
-        median[median == 0] = np.mean(median)
-        vid_norm[:, :, k] = VID[:, :, k] / median
-        
-    else:
-        median = np.median(VID[:, :, k-nframes:k+nframes], axis=2)
-        median[median == 0] = np.mean(median)
-        vid_norm[:, :, k] = VID[:, :, k] / median
+for k, median in tqdm(f.moving_median_images(VID, 2*nframes, dtype='float32'), total=nk):
+    median[median == 0] = np.mean(median)
+    vid_norm[:, :, k] = VID[:, :, k] / median
 
 
 #%%
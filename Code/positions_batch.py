@@ -47,7 +47,7 @@ CALC_MEDIAN = OPTIONS[5]
 
 # Import time
 T0 = time.time()
-vid = f.videoImport(PATH, 0)
+vid = f.VideoSource(PATH)
 T_video_import = time.time() - T0
 
 # Median Image
@@ -96,7 +96,7 @@ PARAMETER_LIST = []
 for j in range(len(THRESHOLD)):
 
     # NUM_FRAMES = 5
-    VID = vid[:, :, :NUM_FRAMES[j]]
+    VID = vid
     LOCS = np.empty((NUM_FRAMES[j], 3), dtype=object)
     # INTENSITY = np.empty(NUM_FRAMES, dtype=object)
     
@@ -111,7 +111,7 @@ for j in range(len(THRESHOLD)):
     bar = Bar('Processing', max=NUM_FRAMES[j], suffix='%(percent).1f%% - %(eta)ds')
     
     for i in range(NUM_FRAMES[j]):
-        I = VID[:, :, i]
+        I = VID.frame(i)
         
         T0_RS = time.time()
         IM = f.rayleighSommerfeldPropagator(I, I_MEDIAN, N, LAMBDA, FS, SZ, NUMSTEPS[j], True).astype('float32')
@@ -135,7 +135,7 @@ for j in range(len(THRESHOLD)):
         LOCS[i, 0] = f.positions3D(GS, peak_min_distance=PEAK_MIN_DISTANCE[j],  num_particles=1, MPP=MPP)
         T_positions3D.append(time.time() - T0_positions3D)
     
-        A = LOCS[i, 0].astype('int')
+        A = f.yxz_index(LOCS[i, 0], GS.shape)
         LOCS[i, 1] = IM[A[:, 0], A[:, 1], A[:, 2]]
         LOCS[i, 2] = GS[A[:, 0], A[:, 1], A[:, 2]]
         T.append(time.time()-T0_loop)
@@ -27,7 +27,7 @@ PATH = '/media/erick/NuevoVol/LINUX_LAP/PhD/Colloids/20x_50Hz_100us_642nm_colloi
 
 
 T0 = time.time()
-VID = f.videoImport(PATH, 0)
+VID = f.VideoSource(PATH, dtype='uint8')
 FRAMES_MEDIAN = 20
 I_MEDIAN = f.medianImage(VID, FRAMES_MEDIAN)
 I_MEDIAN[I_MEDIAN == 0] = np.mean(I_MEDIAN)
@@ -77,7 +77,7 @@ def my_function(TUPLE):
     # GS[GS < THRESHOLD] = 0
     LOCS = np.empty((1, 3), dtype=object)
     LOCS[0, 0] = f.positions3D(GS, peak_min_distance=20, num_particles='None', MPP=MPP)  # , peak_min_distance, num_particles, MP
-    A = LOCS[0, 0].astype('int')
+    A = f.yxz_index(LOCS[0, 0], GS.shape)
     # LOCS[0, 1] = IM[A[:, 0], A[:, 1], A[:, 2]]
     LOCS[0, 1] = GS[A[:, 0], A[:, 1], A[:, 2]]        #LOCS are in pixels, still need o be converteed to um
     LOCS[0, 2] = GS[A[:, 0], A[:, 1], A[:, 2]]
@@ -95,10 +95,9 @@ def my_function(TUPLE):
     return X, Y, Z, I_FS, I_GS
 
     
-IT = np.empty((NUM_FRAMES), dtype=object)
+IT = (VID.frame(i) for i in range(NUM_FRAMES))
 MED = np.empty((NUM_FRAMES), dtype=object)
 for i in range(NUM_FRAMES):
-    IT[i] = VID[:, :, i]
     MED[i] = I_MEDIAN
 
 if __name__ == "__main__":    
@@ -107,7 +106,7 @@ if __name__ == "__main__":
     T0 = time.time()
     pool = Pool(cpu_count())
     #pool = Pool(1)
-    results = pool.map(my_function, zip(IT, MED))
+    results = list(pool.imap(my_function, zip(IT, MED)))     # imap reads frames lazily
     # results = pool.map_async(my_function, zip(IT, MED))
     # results = pool.imap_unordered(my_function, zip(IT, MED))
     # results = pool.apply_async(my_function, zip(IT, MED), callback=update)
@@ -116,18 +115,12 @@ if __name__ == "__main__":
     T = time.time() - T0
     print('\n Elapsed time: ', T)
 
-    POSITIONS = pd.DataFrame(columns=['X', 'Y', 'Z', 'I_FS', 'I_GS', 'FRAME'])
-    for i in range(NUM_FRAMES):
-      # XYZ, I_FS, I_GS, FRAME = LOCS[i, 0], LOCS[i, 1], LOCS[i, 2], i*np.ones_like(LOCS[i, 2])
-            
-        X, Y, Z, I_FS, I_GS, FRAME = results[i][0][0], results[i][1][0], results[i][2][0], results[i][3][0], results[i][4][0], i*np.ones_like(results[i][0][0])
-        DATA = np.concatenate((np.expand_dims(X, axis=1), np.expand_dims(Y, axis=1), np.expand_dims(Z, axis=1), np.expand_dims(I_FS, axis=1), np.expand_dims(I_GS, axis=1), np.expand_dims(FRAME, axis=1)), axis=1)
-        POSITIONS = POSITIONS.append(pd.DataFrame(DATA, columns=['X', 'Y', 'Z', 'I_FS', 'I_GS', 'FRAME']))
+    POSITIONS = f.positions_table(results)     # results are in frame order (imap)
 
     if export_csv:        
         # EXPORT_PATH = PATH[:-4]+'_TH01_MPD35_multiprocess.csv'
-        EXPORT_PATH = gui.filesavebox(filetypes='csv', default='.csv', msg='Save file')
-        POSITIONS.to_csv(EXPORT_PATH)  # For leptospira data
+        EXPORT_PATH = gui.filesavebox(filetypes=['*.parquet', '*.feather', '*.npz', '*.csv'], default='.parquet', msg='Save file')
+        EXPORT_PATH = f.save_table(POSITIONS, EXPORT_PATH, {'video': PATH})  # For leptospira data
 	
 #%%  3D Scatter Plot
 from mpl_toolkits.mplot3d import Axes3D
@@ -10,15 +10,13 @@ Created on Thu May 21 20:17:55 2020
 
 #%% Import libraries
 import os
+import shutil
 import numpy as np
 import PySimpleGUI as sg
 import pandas as pd
 import matplotlib.pyplot as plt
 import functions as f
 from time import time
-from multiprocessing import Pool
-from multiprocessing import cpu_count
-from tqdm import tqdm
 
 #%% GUI for selecting files and parameters
 if __name__ == '__main__':
@@ -39,7 +37,11 @@ if __name__ == '__main__':
         [sg.Text('Peak Min Distance (20, 40, 60)', size=(35, 1)), sg.InputText(default_text=20, key='-PMD-')],
         [sg.Text('Frame Rate', size=(35, 1)), sg.InputText(default_text=50, key='-FRAMERATE-')],
         [sg.Checkbox('Invert Video', default=False, key='-INVERT-')],
-        [sg.Checkbox('Export as CSV', default=True, key='-EXPORT-')],
+        [sg.Text('Normalization (moving median window)', size=(35, 1)), sg.Combo(['median', 'stream', 'moving'], default_value='median', key='-NORMALIZATION-'), sg.InputText(default_text=40, size=(5, 1), key='-WINDOW-')],
+        [sg.Checkbox('Single precision (float32)', default=False, key='-FLOAT32-')],
+        [sg.Checkbox('Low memory streaming', default=False, key='-STREAM-')],
+        [sg.Checkbox('Export results', default=True, key='-EXPORT-'), sg.Combo(['parquet', 'feather', 'npz', 'csv'], default_value='parquet', key='-FORMAT-')],
+        [sg.Checkbox('Resume from checkpoints of a previous run', default=False, key='-RESUME-')],
         [sg.Text('Number of frames for calculations', size=(35, 1)), sg.InputText(default_text='', key='-NUMFRAMES-')],
         [sg.Button('Add File'), sg.Button('Start'), sg.Cancel()]
     ]
@@ -56,7 +58,13 @@ if __name__ == '__main__':
     PMD = []
     FRAME_RATE = []
     INVERT_VIDEO = []
+    NORMALIZATION = []
+    WINDOW = []
+    DTYPE = []
+    STREAM = []
     export = []
+    table_format = []
+    resume = []
     num_frames = []
     scheme = []
     params = []
@@ -107,7 +115,13 @@ if __name__ == '__main__':
             PMD.append(int(values['-PMD-']))
             FRAME_RATE.append(int(values['-FRAMERATE-']))
             INVERT_VIDEO.append(values['-INVERT-'])          
+            NORMALIZATION.append(values['-NORMALIZATION-'])
+            WINDOW.append(int(values['-WINDOW-']))
+            DTYPE.append('float32' if values['-FLOAT32-'] else 'float64')
+            STREAM.append(values['-STREAM-'])
             export.append(values['-EXPORT-'])
+            table_format.append('.'+values['-FORMAT-'])
+            resume.append(values['-RESUME-'])
             
             if values['-NUMFRAMES-'] == '':
                 num_frames.append([])
@@ -126,129 +140,35 @@ if __name__ == '__main__':
     
 #%% Position detection
     
-    data = []
-    times = []
-    for k in range(len(PATH)): 
-        VID = f.videoImport(PATH[k], 0)
-        ni, nj, nk = np.shape(VID)
-        
-        
-        if INVERT_VIDEO[k]:
-            for i in range(nk):
-                VID[:, :, i] = VID[:, :, i].max() - VID[:, :, i]
-    
-        FRAMES_MEDIAN = 20
-        I_MEDIAN = f.medianImage(VID, FRAMES_MEDIAN)
-        # I_MEDIAN = np.ones((VID.shape[0], VID.shape[1]))
-        
-        if num_frames[k] == []:
-            NUM_FRAMES = nk
-        else:
-            NUM_FRAMES = num_frames[k]
-            
-        IT = np.empty((NUM_FRAMES), dtype=object)
-        MED = np.empty((NUM_FRAMES), dtype=object)
-        n = np.empty((NUM_FRAMES), dtype=object)
-        lam = np.empty((NUM_FRAMES), dtype=object)
-        mpp = np.empty((NUM_FRAMES), dtype=object)
-        sz = np.empty((NUM_FRAMES), dtype=object)
-        numsteps = np.empty((NUM_FRAMES), dtype=object)
-        threshold = np.empty((NUM_FRAMES), dtype=object)
-        pmd = np.empty((NUM_FRAMES), dtype=object)
-        
-        for i in range(NUM_FRAMES):
-            IT[i] = VID[:, :, i]
-            MED[i] = I_MEDIAN
-            n[i] = N[k]
-            lam[i] = LAMBDA[k]
-            mpp[i] = MPP[k]
-            sz[i] = SZ[k]
-            numsteps[i] = NUMSTEPS[k]
-            threshold[i] = THRESHOLD[k]
-            pmd[i] = PMD[k]
-        
-        pool = Pool(cpu_count())     # Number of cores to use
-        results = []
-        T0 = time()
+    # All the queued files share one Pool, the next file is decoded while the current one is processed.
+    # Exported files are checkpointed every 100 frames next to the output file
+    expaths = [f.positions_path(PATH[k], scheme[k], THRESHOLD[k], PMD[k], SZ[k], NUMSTEPS[k], table_format[k]) for k in range(len(PATH))]
+    JOBS = [dict(PATH=PATH[k], scheme=scheme[k], N=N[k], LAMBDA=LAMBDA[k], MPP=MPP[k], SZ=SZ[k],
+                 NUMSTEPS=NUMSTEPS[k], THRESHOLD=THRESHOLD[k], PMD=PMD[k], FRAME_RATE=FRAME_RATE[k],
+                 invert=INVERT_VIDEO[k], frames=None if num_frames[k] == [] else num_frames[k],
+                 normalization=NORMALIZATION[k], window=WINDOW[k],
+                 options={'dtype': DTYPE[k], 'stream': STREAM[k]},
+                 checkpoint=os.path.splitext(expaths[k])[0]+'_checkpoints' if export[k] else None,
+                 resume=resume[k]) for k in range(len(PATH))]
     
-        print('Processing File '+str(k+1)+' of '+str(len(PATH))+': '+ os.path.split(PATH[k])[-1])
+    data = [None]*len(PATH)
+    times = [None]*len(PATH)
+    print('Processing '+str(len(PATH))+' files')
+    for k, POSITIONS, T in f.detect_positions_jobs(JOBS):
+        print('Finished File '+str(k+1)+' of '+str(len(PATH))+': '+ os.path.split(PATH[k])[-1])
         print('Parameters: ')
         print(params[k])
-        
-        if scheme[k] == '-RS-':
-            for _ in tqdm(pool.imap_unordered(f.positions_batch, zip(IT, MED, n, lam, mpp, sz, numsteps, threshold, pmd)), 
-                          total=NUM_FRAMES):
-                results.append(_)
-        
-        elif scheme[k] == '-MOD-':
-            for _ in tqdm(pool.imap_unordered(f.positions_batch_modified, zip(IT, MED, n, lam, mpp, sz, numsteps, threshold, pmd)), 
-                          total=NUM_FRAMES):
-                results.append(_)
-                
-        times.append(time() - T0)   
-        
-        # for i, item in enumerate(pool.imap_unordered(f.positions_batch, zip(IT, MED, n, lam, mpp, sz, numsteps, threshold, pmd))):
-        #     sg.one_line_progress_meter('This is my progress meter!', 
-        #                                i+1, 
-        #                                NUM_FRAMES,
-        #                                'Processing File '+str(k+1)+' of '+str(len(PATH))+': ',
-        #                                os.path.split(PATH[k])[-1],
-        #                                values[1:],
-        #                                orientation='h')
-        #     results.append(item)
-            
-        pool.close()
-        pool.join()
-        
-        POSITIONS = pd.DataFrame(columns=['X', 'Y', 'Z', 'I_FS', 'I_GS', 'FRAME', 'TIME'])
-        for i in range(NUM_FRAMES):
-    
-            X = results[i][0][0]
-            Y = results[i][1][0]
-            Z = results[i][2][0]
-            I_FS = results[i][3][0]
-            I_GS = results[i][4][0]
-            FRAME = i*np.ones_like(results[i][0][0])
-            TIME = FRAME / FRAME_RATE[k]
-            
-            DATA = np.concatenate((np.expand_dims(X, axis=1), 
-                                   np.expand_dims(Y, axis=1), 
-                                   np.expand_dims(Z, axis=1), 
-                                   np.expand_dims(I_FS, axis=1), 
-                                   np.expand_dims(I_GS, axis=1), 
-                                   np.expand_dims(FRAME, axis=1), 
-                                   np.expand_dims(TIME, axis=1)), 
-                                  axis=1)
-            # POSITIONS = POSITIONS.append(pd.DataFrame(DATA, 
-                                                      # columns=['X', 'Y', 'Z', 'I_FS', 'I_GS', 'FRAME', 'TIME']))
-            
-            POSITIONS = pd.concat([POSITIONS, pd.DataFrame(DATA, 
-                                                      columns=['X', 'Y', 'Z', 'I_FS', 'I_GS', 'FRAME', 'TIME'])],
-                                  ignore_index=True)
-        
-        POSITIONS = POSITIONS.astype('float')
-        POSITIONS['TIME'] = POSITIONS['TIME'].round(3)
+        times[k] = T
 
-#%% Export CSV Files
+#%% Export results
 
         if export[k]:
-            path = os.path.split(PATH[k])[:-1][0]
-            pp = os.path.split(PATH[k])[-1][:-4]
-            
-            if scheme[k] == '-RS-':
-                expath = path+'/'+pp+'_TH'+str(THRESHOLD[k])+'_PMD'+str(PMD[k])+'_SZ'+str(SZ[k])+'_NUMSTEPS'+str(NUMSTEPS[k])+'_RS'+'.csv'
-                POSITIONS.to_csv(expath)
-            
-            elif scheme[k] == '-MOD-':
-                expath = path+'/'+pp+'_TH'+str(THRESHOLD[k])+'_PMD'+str(PMD[k])+'_SZ'+str(SZ[k])+'_NUMSTEPS'+str(NUMSTEPS[k])+'_MOD'+'.csv'
-                POSITIONS.to_csv(expath)
+            expath = f.save_table(POSITIONS, expaths[k], params[k].iloc[0].to_dict())
+            shutil.rmtree(JOBS[k]['checkpoint'])
             print('Exported to: \n', expath)
             print('---------------------------------------------------------------------------------------------------------------------------------------------------')
                
-        
-    #     T = time.time - T0
-    #     times.append(T)
-        data.append(POSITIONS)
+        data[k] = POSITIONS
         
     print('Done!')
     
@@ -264,7 +184,7 @@ if __name__ == '__main__':
         
         
         # path = gui.fileopenbox(default='/media/erick/NuevoVol/LINUX_LAP/PhD/Thesis/', multiple=False)
-        # POSITIONS = pd.read_csv(path)
+        # POSITIONS = f.load_table(path)
         POSITIONS = data[0]
         # # POSITIONS = DF
         
@@ -5,6 +5,7 @@ Created on Tue Aug  9 21:08:38 2022
 
 @author: erick
 """
+import os
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
@@ -17,7 +18,7 @@ from mpl_toolkits.mplot3d import Axes3D
 from matplotlib import pyplot
 
 path = gui.fileopenbox(default='/media/erick/NuevoVol/LINUX_LAP/PhD/Thesis/Results/1/')
-smoothed_curves_df = pd.read_csv(path)
+smoothed_curves_df = f.load_table(path)
 
 #%%
 # For Noramal video
@@ -50,7 +51,7 @@ for pn in particle_num:
     
 # expath = '/media/erick/NuevoVol/LINUX_LAP/PhD/Thesis/Results/1/Archea/Plots/'
 tracks_w_speed = pd.DataFrame(np.transpose([xx[1:], yy[1:], zz[1:], tt[1:], pp[1:], sp[1:]]), columns=['X', 'Y', 'Z', 'TIME', 'PARTICLE', 'SPEED'])
-tracks_w_speed.to_csv(path[:-4]+'_speed.csv')
+f.save_table(tracks_w_speed, os.path.splitext(path)[0]+'_speed'+os.path.splitext(path)[1], smoothed_curves_df.attrs)
 
 
 # PATH = gui.fileopenbox(default='/media/erick/NuevoVol/LINUX_LAP/PhD/', filetypes='.csv')